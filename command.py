@@ -1,13 +1,12 @@
 # encoding: utf-8
 
+import os
 import sys
 import argparse
 from workflow import Workflow, PasswordNotFound
-from common import qnotify, error, get_stored_data, open_url, wait_for_public_token, get_link_func, CERT_FILE, KEY_FILE, set_stored_data, ICONS_DEFAULT
-from plaid import Plaid
-from server import run_server, stop_server
-from common import get_environment, get_secure_value, set_secure_value, set_current_user, ALL_ENV, ALL_USER, reset_secure_values, get_current_user, get_db_file, get_protocol, set_category, get_category, category_name, get_category_icon, get_bank_icon
-from db import TxnDB
+from common import qnotify, error, open_url, wait_for_public_token, get_link_func, CERT_FILE, KEY_FILE, get_metadata, save_metadata, get_db
+from common import get_environment, get_secure_value, set_credential, get_items, set_items, get_local_value, set_local_value, set_current_user, ALL_ENV, ALL_USER, reset_secure_values, get_current_user, get_db_file, get_protocol, set_category, get_category, category_name, find_category_icon
+from common import get_sync_concurrency, secure_session, commit_secure_values, take_icon_queue
 from time import time
 
 log = None
@@ -15,13 +14,25 @@ log = None
 def change_env(wf, env):
     wf.settings['environment'] = env
     
-def update_items(wf, plaid):
-    items = get_secure_value(wf, 'items', {})
-    banks = get_stored_data(wf, 'banks', {})
-    icons = get_stored_data(wf, 'icons', ICONS_DEFAULT)
+def update_items(wf, plaid, prefetch=None):
+    from concurrent.futures import ThreadPoolExecutor
+    from prefetch import IconPrefetch
+    items = get_items(wf)
+    banks = get_metadata(wf, 'banks')
+    icons = get_metadata(wf, 'icons')
+    # saved without its access token, it is dropped and has to be linked again
+    for item_id, item in get_items(wf, False).items():
+        if item_id not in items:
+            name = banks[item['institution_id']]['name'] if item.get('institution_id') in banks else item_id
+            log.debug(f'{item_id} has no access token')
+            qnotify('Plaid', f'{name} needs to be linked again')
+    own = prefetch is None
+    if own: prefetch = IconPrefetch(wf, icons)
+    with ThreadPoolExecutor(max_workers=get_sync_concurrency(wf)) as pool:
+        results = dict(zip(items.keys(), pool.map(lambda x: plaid.get_item(x['access_token']), items.values())))
     for item_id in items:
         item = items[item_id]
-        result = plaid.get_item(item['access_token'])
+        result = results[item_id]
         item['institution_id'] = result['institution_id']
         item['error'] = result['error']
         item['consent_expiration_time'] = result['consent_expiration_time']
@@ -29,74 +40,148 @@ def update_items(wf, plaid):
         if item['institution_id'] not in banks:
             bank = plaid.get_institution_by_id(item['institution_id'])
             if bank:
+                # the icon prefetch fills it in once the sync is done
+                bank['icon'] = None
                 banks[item['institution_id']] = bank
-                banks[item['institution_id']]['icon'] = get_bank_icon(wf, item['institution_id'], banks, icons)
-    set_secure_value(wf, 'items', items)
-    set_stored_data(wf, 'banks', banks)
-    set_stored_data(wf, 'icons', icons)
+                prefetch.bank(banks, item['institution_id'])
+    set_items(wf, items)
+    if own: prefetch.finish()
+    save_metadata(wf, 'banks')
+    save_metadata(wf, 'icons')
 
 def add_item(wf, item):
     if not item: return
-    items = get_secure_value(wf, 'items', {})
+    items = get_items(wf)
     items[item['item_id']] = item
-    set_secure_value(wf, 'items', items)
+    set_items(wf, items)
     
+def link_item(wf, plaid, public_token):
+    """Exchange a public token for the item it links and save it, returns the item id"""
+    result = plaid.exchange_public_token(public_token=public_token)
+    if 'access_token' not in result: return None
+    item = plaid.get_item(result['access_token'])
+    item['access_token'] = result['access_token']
+    item['item_id'] = result['item_id']
+    add_item(wf, item)
+    # a public token only exchanges once, the access token is written before anything else can fail
+    commit_secure_values(wf)
+    update_items(wf, plaid)
+    return item['item_id']
+
 def del_item(wf, item_id, plaid):
-    items = get_secure_value(wf, 'items', {})
+    items = get_items(wf)
     if item_id not in items: return None
 
-    banks = get_stored_data(wf, 'banks', {})
+    banks = get_metadata(wf, 'banks')
     item = items[item_id]
     name = banks[item['institution_id']]['name']
-    db = TxnDB(get_db_file(wf), wf.logger)
-    accounts = get_secure_value(wf, 'accounts', {})
+    accounts = get_local_value(wf, 'accounts', {})
     ids = list(accounts.keys())
-    for account_id in ids:
-        if item_id == accounts[account_id]['item_id']: 
-            db.del_account_txns(account_id)
-            del accounts[account_id]
+    with get_db(wf) as db:
+        for account_id in ids:
+            if item_id == accounts[account_id]['item_id']: 
+                db.del_account_txns(account_id)
+                del accounts[account_id]
     result = plaid.del_item(item['access_token'])
     del items[item_id]
-    set_secure_value(wf, 'accounts', accounts)
-    set_secure_value(wf, 'items', items)
+    set_local_value(wf, 'accounts', accounts)
+    set_items(wf, items)
     return name
     
 def update_categories(wf, plaid):
     log.debug('updating categories...')
-    categories = get_stored_data(wf, 'categories', {})
-    icons = get_stored_data(wf, 'icons', ICONS_DEFAULT)
+    categories = get_metadata(wf, 'categories')
+    icons = get_metadata(wf, 'icons')
     newcats = plaid.get_categories(wf)
-    categories = {**categories, **newcats}
-    for category_id in categories:
-        icon = get_category_icon(wf, category_id, categories, icons)
-        if icon: categories[category_id]['icon'] = icon
+    changed = 0
+    for category_id in newcats:
+        category = newcats[category_id]
+        old = categories[category_id] if category_id in categories else None
+        # icons are only worked out for new or renamed categories and ones without an icon on disk,
+        # the rest keep theirs - icons added to or removed from the bundled set are picked up here
+        if old and old['list'] == category['list'] and old.get('icon') and os.path.exists(old['icon']):
+            category['icon'] = old['icon']
+        else:
+            category['icon'] = find_category_icon(wf, category['list'], icons)
+            changed += 1
+        categories[category_id] = category
+    log.debug(f'worked out icons for {changed} new, changed or missing categories')
     categories[0] = {'id': 0, 'list':[], 'icon': None}
     #log.debug(categories)
-    set_stored_data(wf, 'categories', categories)
-    set_stored_data(wf, 'icons', icons)
+    save_metadata(wf, 'categories')
+    save_metadata(wf, 'icons')
     return categories
 
+def backfill_icons(wf):
+    """Fetch the icons the filter queued because it had none to show
+
+    Keeps going until the queue is empty, the filter adds to it while this runs.
+    """
+    from prefetch import IconPrefetch
+    count = 0
+    queue = take_icon_queue(wf)
+    while queue:
+        merchants = get_metadata(wf, 'merchants')
+        banks = get_metadata(wf, 'banks')
+        icons = get_metadata(wf, 'icons')
+        prefetch = IconPrefetch(wf, icons)
+        for type, id in queue:
+            if 'merchant' == type and id in merchants:
+                prefetch.merchant(merchants, id)
+            elif 'bank' == type and id in banks:
+                prefetch.bank(banks, id)
+        prefetch.finish()
+        save_metadata(wf, 'merchants')
+        save_metadata(wf, 'banks')
+        save_metadata(wf, 'icons')
+        count += len(queue)
+        queue = take_icon_queue(wf)
+    return count
+
 def reset_cursors(wf):
-    items = get_secure_value(wf, 'items', {})
+    items = get_items(wf)
     for item in items:
         items[item]['txn_cursor'] = None
-    set_secure_value(wf, 'items', items)
+    set_items(wf, items)
+
+def sync_item(plaid, item_id, item, cursor, queue):
+    """Fetch accounts and sync pages for one item and hand them to the DB writer
+
+    Runs in a worker thread - nothing here touches the DB or stored data.
+    """
+    try:
+        actlist = plaid.get_accounts(item)
+        queue.put(('accounts', item_id, actlist))
+        if type(actlist) is not list:
+            queue.put(('done', item_id, None))
+            return
+        for page in plaid.get_transactions(item, cursor):
+            queue.put(('page', item_id, page))
+        queue.put(('done', item_id, None))
+    except Exception as e:
+        queue.put(('done', item_id, e))
 
 def update_transactions(wf, plaid):
+    from concurrent.futures import ThreadPoolExecutor
+    from queue import Queue
+    from prefetch import IconPrefetch
     log.debug('updating transactions...')
-    txns = None
-    db = TxnDB(get_db_file(wf), wf.logger)
+    pages = 0
+    db = get_db(wf)
     
     start = time()
-    update_items(wf, plaid)
+    icons = get_metadata(wf, 'icons')
+    # icons download alongside the sync and are only waited for once every page is saved
+    prefetch = IconPrefetch(wf, icons)
+    update_items(wf, plaid, prefetch)
     log.debug(f"{(time() - start):0.3f} to update items")
     start = time()
-    items = get_secure_value(wf, 'items', {})
-    accounts = get_secure_value(wf, 'accounts', {})
-    nicks = get_secure_value(wf, 'nicks', {})
-    merchants = get_stored_data(wf, 'merchants', {})
-    categories = get_stored_data(wf, 'categories', {})
-    banks = get_stored_data(wf, 'banks', {})
+    items = get_items(wf)
+    accounts = get_local_value(wf, 'accounts', {})
+    nicks = get_local_value(wf, 'nicks', {})
+    merchants = get_metadata(wf, 'merchants')
+    categories = get_metadata(wf, 'categories')
+    banks = get_metadata(wf, 'banks')
     log.debug(f"{(time() - start):0.3f} to load stored data")
     if 0 not in categories:
         start = time()
@@ -105,44 +190,75 @@ def update_transactions(wf, plaid):
     if not items:
         log.debug('No items found. Please add items first..')
         qnotify('Plaid', 'No Items Found!')
-    for item_id in items:
-        try:
-            log.debug('updating item '+item_id)
-            single = items[item_id]
-            if items[item_id]['error']: 
-                log.debug(f"{banks[single['institution_id']]['name']} has an error.. Skipping..")
-                qnotify('Plaid', f"{banks[single['institution_id']]['name']} needs auth update")
-                continue
-            start = time()
-            actlist = plaid.get_accounts(single, banks)
-            log.debug(f"{(time() - start):0.3f} to get accounts")
-            if 'ITEM_LOGIN_REQUIRED' == actlist:
-                items[item_id]['error'] = actlist
-                log.debug(f'{item_id} item has error {actlist}')
-                qnotify('Plaid', f"{banks[single['institution_id']]['name']} needs auth update")
-            elif type(actlist) is list and 'error' in items[item_id] and items[item_id]['error']:
-                items[item_id]['error'] = None
-            for i in range(len(actlist)):
-                log.debug(actlist[i])
-                if actlist[i]['account_id'] in nicks:
-                    actlist[i]['nick'] = nicks[actlist[i]['account_id']]
-                accounts[actlist[i]['account_id']] = actlist[i]
-            start = time()
-            txns = plaid.get_transactions(single, merchants)
-            for t in txns:
-                log.debug(t)
-                db.save_txn(t, wf)
-            log.debug(f"{(time() - start):0.3f} to get and save transactions")
-        except: 
-            pass
-    set_secure_value(wf, 'items', items)            
-    set_secure_value(wf, 'accounts', accounts)
-    set_stored_data(wf, 'merchants', merchants)
-    set_stored_data(wf, 'categories', categories)
-    set_stored_data(wf, 'banks', banks)
-    return txns
+    with db:
+        start = time()
+        concurrency = get_sync_concurrency(wf)
+        # bounded so fast institutions can't pile up pages faster than they are written
+        queue = Queue(maxsize=concurrency * 2)
+        running = 0
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for item_id in items:
+                single = items[item_id]
+                if single['error']: 
+                    log.debug(f"{banks[single['institution_id']]['name']} has an error.. Skipping..")
+                    qnotify('Plaid', f"{banks[single['institution_id']]['name']} needs auth update")
+                    continue
+                # cursors live in the DB next to the rows they cover, older installs kept them on the item
+                cursor = db.get_cursor(item_id) or single.pop('txn_cursor', None)
+                pool.submit(sync_item, plaid, item_id, single, cursor, queue)
+                running += 1
+            # this thread is the only DB writer - it keeps draining the queue
+            # even after a failure so no worker is left blocked on a full queue
+            failed = set()
+            while running:
+                kind, item_id, result = queue.get()
+                single = items[item_id]
+                try:
+                    if 'accounts' == kind:
+                        actlist = result
+                        if 'ITEM_LOGIN_REQUIRED' == actlist:
+                            single['error'] = actlist
+                            log.debug(f'{item_id} item has error {actlist}')
+                            qnotify('Plaid', f"{banks[single['institution_id']]['name']} needs auth update")
+                        elif type(actlist) is list and 'error' in single and single['error']:
+                            single['error'] = None
+                        for act in (actlist if type(actlist) is list else []):
+                            log.debug(act)
+                            if act['account_id'] in nicks:
+                                act['nick'] = nicks[act['account_id']]
+                            accounts[act['account_id']] = act
+                    elif 'page' == kind and item_id not in failed:
+                        # later pages are skipped after a failure so the saved cursor never passes a lost page
+                        for merchant_id in plaid.update_metadata(result['added'] + result['modified'], merchants):
+                            prefetch.merchant(merchants, merchant_id)
+                        db.apply_sync(result, wf, item_id, [merchants])
+                        pages += 1
+                    elif 'done' == kind:
+                        running -= 1
+                        if result: raise result
+                except Exception as e:
+                    failed.add(item_id)
+                    log.debug(f'{item_id} sync failed: {e}')
+                    name = banks[single['institution_id']]['name'] if single.get('institution_id') in banks else item_id
+                    qnotify('Plaid', f"{name} update failed")
+        log.debug(f"{(time() - start):0.3f} to get and save {pages} pages of transactions")
+    start = time()
+    prefetch.finish()
+    log.debug(f"{(time() - start):0.3f} waiting for icons after the sync")
+    set_items(wf, items)            
+    set_local_value(wf, 'accounts', accounts)
+    save_metadata(wf, 'merchants')
+    save_metadata(wf, 'categories')
+    save_metadata(wf, 'banks')
+    save_metadata(wf, 'icons')
+    return pages
     
 def main(wf):
+    # every secure store change a command makes is written once, when it finishes
+    with secure_session(wf):
+        return run_command(wf)
+
+def run_command(wf):
     # build argument parser to parse script args and collect their
     # values
     parser = argparse.ArgumentParser()
@@ -168,6 +284,8 @@ def main(wf):
     parser.add_argument('--update', dest='update', action='store_true', default=False)
     parser.add_argument('--refresh', dest='refresh', nargs='?', default=False)
     parser.add_argument('--upcat', dest='upcat', action='store_true', default=False)
+    parser.add_argument('--icons', dest='icons', action='store_true', default=False)
+    parser.add_argument('--migrate', dest='migrate', action='store_true', default=False)
     parser.add_argument('--link', dest='link', nargs='?', default=None)
     parser.add_argument('--delete', dest='delete', nargs='?', default=None)
     parser.add_argument('--kill', dest='kill', action='store_true', default=False)
@@ -191,7 +309,7 @@ def main(wf):
     if args.clear or args.reinit:
         current_environment = get_environment(wf)
         reset_cursors(wf)
-        set_secure_value(wf, 'accounts', {})
+        set_local_value(wf, 'accounts', {})
         wf.clear_settings()
         wf.clear_data(lambda x: current_environment in x)
         change_env(wf, current_environment)
@@ -211,21 +329,21 @@ def main(wf):
     # save Client ID if that is passed in
     if args.clientid:  # Script was passed an API key
         log.debug("saving client id "+args.clientid)
-        set_secure_value(wf, 'client_id', args.clientid, ALL_USER, ALL_ENV)
+        set_credential(wf, 'client_id', args.clientid, ALL_USER, ALL_ENV)
         qnotify('Plaid', 'Client ID Saved')
         return 0  # 0 means script exited cleanly
 
     
     log.debug(f"{args.category_id} : {args.merchant}")
     if args.category_id and (args.merchant_id or args.merchant or args.txntext):
-        merchants = get_stored_data(wf, 'merchants', {})
+        merchants = get_metadata(wf, 'merchants')
         category_id = int(args.category_id)
         id = args.merchant_id if args.merchant_id is not None else args.merchant
         set_category(wf, id, category_id)
         merchant = merchants[args.merchant_id]['name'] if args.merchant_id else args.merchant
         category = category_name(wf, category_id)
-        db = TxnDB(get_db_file(wf), wf.logger)
-        db.update_txn_category(category_id, args.merchant_id, merchant, args.txntext, category_name(wf, category_id, True))
+        with get_db(wf) as db:
+            db.update_txn_category(category_id, args.merchant_id, merchant, args.txntext, category_name(wf, category_id, True))
         qnotify('Plaid', f'{merchant} is now {category}')
         return 0  # 0 means script exited cleanly
     
@@ -239,7 +357,7 @@ def main(wf):
     # save Secret if that is passed in
     if args.secret:  # Script was passed an Hub ID
         log.debug("saving secret "+args.secret)
-        set_secure_value(wf, 'secret', args.secret, ALL_USER)
+        set_credential(wf, 'secret', args.secret, ALL_USER)
         qnotify('Plaid', f'Secret Saved for {get_environment(wf)}')
         return 0  # 0 means script exited cleanly
 
@@ -251,6 +369,18 @@ def main(wf):
         qnotify('Plaid', f"Environment is {args.environment}")
         return 0  # 0 means script exited cleanly
     
+    if args.icons:
+        count = backfill_icons(wf)
+        log.debug(f"fetched icons for {count} queued entries")
+        return 0
+
+    if args.migrate:
+        from db import TxnDB
+        # its own TxnDB - the shared one would defer the batched migrations straight back here
+        with TxnDB(get_db_file(wf), wf.logger) as db:
+            db.connect()
+        return 0
+
     if args.proto:
         log.debug("saving protocol "+args.proto)
         wf.settings['protocol'] = args.proto
@@ -278,50 +408,52 @@ def main(wf):
         error('Secret not found')
         return 0
         
-    plaid = Plaid(client_id=client_id, secret=secret, user_id=user_id, wf=wf)
-                
-    if args.refresh:
-        items = get_secure_value(wf, 'items', {})
-        banks = get_stored_data(wf, 'banks', {})
-        rlist = list(items.values()) if 'all' == args.refresh else [items[args.refresh]]
-        name = 'All' if 'all' == args.refresh else banks[items[args.refresh]['institution_id']]['name']
-        log.debug("forcing refresh of transactions..")
-        for item in rlist:
-            plaid.force_refresh(item['access_token'])
-        qnotify('Plaid', f"Forced Refresh of {name} Transactions")
-        return 0
-
     if args.acctid:  # Script was passed an account ID
-        accounts = get_secure_value(wf, 'accounts', {})
+        accounts = get_local_value(wf, 'accounts', {})
         if args.filter:
             log.debug("saving filtered account id "+args.acctid)
             acct_id = args.acctid[:-1] if '-' == args.acctid[-1] else args.acctid
             if 'all' == acct_id:
-                set_secure_value(wf, 'acct_filter', [])
+                set_local_value(wf, 'acct_filter', [])
                 qnotify('Plaid', 'Account Filter Removed')
             elif acct_id in accounts:
-                acct_filter = get_secure_value(wf, 'acct_filter', [])
+                acct_filter = get_local_value(wf, 'acct_filter', [])
                 if acct_id not in acct_filter:
                     acct_filter.append(acct_id)
                 else:
                     acct_filter.remove(acct_id)
-                set_secure_value(wf, 'acct_filter', acct_filter)
+                set_local_value(wf, 'acct_filter', acct_filter)
                 name = ','.join([accounts[x]['name'] for x in acct_filter])
                 qnotify('Plaid', 'Account Filter: '+name if name else 'Account Filter Removed')
             else:
                 qnotify('Plaid', 'Account Filter Failed')
             return 0  # 0 means script exited cleanly
         if args.nick:
-            nicks = get_secure_value(wf, 'nicks', {})
+            nicks = get_local_value(wf, 'nicks', {})
             log.debug("adding nickname to "+args.acctid)
             nicks[args.acctid] = args.nick
-            set_secure_value(wf, 'nicks', nicks)
+            set_local_value(wf, 'nicks', nicks)
             accounts[args.acctid]['nick'] = args.nick
-            set_secure_value(wf, 'accounts', accounts)
+            set_local_value(wf, 'accounts', accounts)
             name = accounts[args.acctid]['name']
             qnotify('Plaid', f'{name} nicknamed to {args.nick}')
             return 0
 
+    # account filters and nicknames are local, the API client and its ssl stack are only loaded past them
+    from plaid import Plaid
+    plaid = Plaid(client_id=client_id, secret=secret, user_id=user_id, wf=wf)
+                
+    if args.refresh:
+        items = get_items(wf)
+        banks = get_metadata(wf, 'banks')
+        rlist = list(items.values()) if 'all' == args.refresh else [items[args.refresh]]
+        name = 'All' if 'all' == args.refresh else banks[items[args.refresh]['institution_id']]['name']
+        log.debug("forcing refresh of transactions..")
+        for item in rlist:
+            plaid.force_refresh(item['access_token'])
+        qnotify('Plaid', f"Forced Refresh of {name} Transactions")
+        return 0
+
     # Update items if that is passed in
     if args.update:
         message = 'Accounts & Transactions updated'
@@ -340,6 +472,7 @@ def main(wf):
         return 0  # 0 means script exited cleanly
     
     if args.kill:
+        from server import stop_server
         stop_server(wf)
         
     if args.delete:
@@ -351,7 +484,9 @@ def main(wf):
             qnotify('Plaid', e)
         
     if args.link:
-        items = get_secure_value(wf, 'items', {})
+        # the link server pulls in ssl and http.server, only load it when linking
+        from server import run_server, stop_server
+        items = get_items(wf)
         item = items[args.link] if args.link in items else {}
         try:
             proto = get_protocol(wf)
@@ -364,16 +499,11 @@ def main(wf):
         finally:
             stop_server(wf)            
         if public_token:
-            result = plaid.exchange_public_token(public_token=public_token)
-            if 'access_token' in result:
-                banks = get_stored_data(wf, 'banks', {})
-                item = plaid.get_item(result['access_token'])
-                item['access_token'] = result['access_token']
-                item['item_id'] = result['item_id']
-                add_item(wf, item)
-                name = banks[item['institution_id']]['name']
-                update_items(wf, plaid)
-                qnotify('Plaid', f'Saved {name} Item' if 'access_token' in result else f'{name} Item Save Failed')
+            item_id = link_item(wf, plaid, public_token)
+            if item_id:
+                banks = get_metadata(wf, 'banks')
+                name = banks[get_items(wf, False)[item_id]['institution_id']]['name']
+                qnotify('Plaid', f'Saved {name} Item')
                 result = update_transactions(wf, plaid)
             return 0  # 0 means script exited cleanly
         
@@ -1,128 +1,277 @@
 import subprocess
-from time import sleep
+import sys
+from time import sleep, time
 import re
-from workflow import PasswordNotFound, web
-import json
+from secure import SecureStore, get_backend
 import os.path
 from os import listdir
 from os.path import isfile, join, splitext
 import base64
-from dateutil.parser import parse 
+from datetime import date, datetime
 
 
 SERVER_HOST='localhost'
 SERVER_PORT=8383
 SERVER_PROTOCOL='https'
 DEFAULT_ENV = 'sandbox'
-SECURE_STORE = 'plaid_secure'
 ALL_ENV = 'global'
 ALL_USER = 'config'
 CERT_FILE = 'cert.pem'
 KEY_FILE = 'key.pem'
-STORAGE = None
+STORAGE = None # SecureStore for this process
+STORED_DATA = {} # name -> (file stat, data) for data already loaded by this process
+DATABASES = {} # db file -> TxnDB shared by everything in this process
+TRANSPORT = None # Transport for icon downloads
+LOCAL_STORE = 'state'
+LOCAL_VERSION = 'version'
+LOCAL_KEYS = ['accounts', 'items', 'nicks', 'acct_filter', 'current_user'] # kept out of the secure store
+CREDENTIAL_KEYS = ['client_id', 'secret']
+METADATA_KEYS = {'merchants': str, 'banks': str, 'categories': int}
+MIGRATED = set() # (db file, name) already checked for a legacy pickle
 ICONS_DEFAULT = {'merchant': {},'category': {},'bank': {}}
+SYNC_CONCURRENCY = 4
+PAGE_SIZE = 30 # transactions shown per page of search results
+ICON_RETRY_BASE = 3600 # seconds before a failed icon is tried again, doubled on every failure
+ICON_RETRY_MAX = 30 * 86400
+CHECKED_DIRS = set() # (db file, icon directory) already checked for changes by this process
+ICON_QUEUE = 'icon_queue' # merchants and banks the filter found without an icon
+
+def get_transport():
+    """Transport shared by every download in this process - safe to use from several threads"""
+    global TRANSPORT
+    if not TRANSPORT:
+        from transport import Transport
+        TRANSPORT = Transport()
+    return TRANSPORT
 
 def download_file(filename, url):
-    r = web.get(url, allow_redirects=True)
-    r.save_to_path(filename)
+    r = get_transport().get(url)
+    if 200 != r.status_code: raise IOError(f'{url} returned {r.status_code}')
+    with open(filename, 'wb') as fh:
+        fh.write(r.content)
+
+def icon_key(name):
+    return re.sub(r'[^a-z0-9]', '', name.lower())
 
-def ensure_icon(wf, dir, site, type, url=None):
-    if not site: return None
-    site = re.sub(r'[^a-z0-9]','',site.lower())
+def icon_source(wf, type, key, url=None):
+    """Where the icon for `key` is saved and the URL it comes from, None if there is nowhere to get it"""
+    dir = ensure_icon_dir(wf.datafile(f'{get_environment(wf)}.icons'), type)
     size = 64
-    dir = ensure_icon_dir(dir, type)
-    icon = f'{dir}/{site}.png'
-    if not os.path.exists(icon):
-        if url and 'bank' == type and not url.startswith('http'): # base64 encoded image
-            with open(icon, "wb") as fh:
-                fh.write(base64.urlsafe_b64decode(url))
-        else:
-            url = url if url else (f'https://www.google.com/s2/favicons?domain={site}.com&sz={size}' if 'category' != type else None)
-            if url:
-                try:
-                    download_file(icon, url)
-                except Exception as e:
-                    wf.logger.debug(e)
-                    pass
-    return icon if os.path.exists(icon) else '' # to differentiate from None which means never tried
-
-def get_icon(wf, type, icon, icons=None, url=None, force=False):
-    #wf.logger.debug(f"getting icon for {type} and {icon}")
-    base_dir = wf.datafile(f'{get_environment(wf)}.icons')
-    icon = re.sub(r'[^a-z0-9]', '', icon.lower())
-    icons = get_stored_data(wf, 'icons', ICONS_DEFAULT) if not icons else icons
-    if force or not icons[type]:
-        dirs = [f"{base_dir}/{type}/", f"icons/{type}/"]
-        for dir in dirs:
-            files = [f for f in (listdir(dir) if os.path.exists(dir) else []) if isfile(join(dir, f))]
-            for f in files:
-                icons[type][splitext(f)[0]] = join(dir,f)
-        set_stored_data(wf, 'icons', icons)
-        
-    result = icons[type][icon] if icon in icons[type] else None
-    #wf.logger.debug(f"result is {result}")
-    #if result is None and url:
-    if not result:
-        result = ensure_icon(wf, base_dir, icon, type, url)
-        if result is not None: 
-            icons[type][icon] = result
-    return result
+    url = url if url else (f'https://www.google.com/s2/favicons?domain={key}.com&sz={size}' if 'category' != type else None)
+    return f'{dir}/{key}.png', url
+
+def save_icon(wf, path, url):
+    if url and not url.startswith('http'): # base64 encoded image
+        with open(path, "wb") as fh:
+            fh.write(base64.urlsafe_b64decode(url))
+    elif url:
+        try:
+            # downloaded under a temporary name so a half written icon is never picked up
+            download_file(f'{path}.part', url)
+            os.replace(f'{path}.part', path)
+        except Exception as e:
+            wf.logger.debug(e)
+            pass
+    return path if os.path.exists(path) else '' # to differentiate from None which means never tried
+
+def icon_dirs(wf, type):
+    return [f"{wf.datafile(f'{get_environment(wf)}.icons')}/{type}", f"icons/{type}"]
+
+def dir_mtime(dir):
+    try:
+        return os.stat(dir).st_mtime_ns
+    except OSError:
+        return None
+
+def icon_record(value):
+    """Index entry for an icon - older versions stored just the path, or '' after a failed download"""
+    if isinstance(value, dict): return value
+    return {'path': value, 'url': None, 'fetched': 0, 'failures': 0 if value else 1}
+
+def refresh_icon_index(wf, type, icons, force=False):
+    """Index the files of an icon directory, only if it changed since it was last indexed
+
+    Each directory is checked once per process with a single stat, this
+    covers the bundled icons as well as downloaded ones.
+    """
+    db = get_db(wf)
+    seen = db.metadata('icons.dirs')
+    for dir in icon_dirs(wf, type):
+        if not force and (db.file, dir) in CHECKED_DIRS: continue
+        CHECKED_DIRS.add((db.file, dir))
+        mtime = dir_mtime(dir)
+        if not force and dir in seen and seen[dir] == mtime: continue
+        wf.logger.debug(f'indexing icons in {dir}')
+        files = {splitext(f)[0]: join(dir, f) for f in (listdir(dir) if mtime else []) if isfile(join(dir, f)) and not f.endswith('.part')}
+        for key in [x for x in icons[type] if (icon_record(icons[type][x])['path'] or '').startswith(f'{dir}/') and x not in files]:
+            del icons[type][key]
+        for key in files:
+            record = icon_record(icons[type][key]) if key in icons[type] else {'url': None, 'fetched': 0}
+            if record.get('path') != files[key]:
+                icons[type][key] = {**record, 'path': files[key], 'failures': 0}
+        icons[type].save()
+        seen[dir] = mtime
+        seen.save()
+
+def lookup_icon(wf, type, key, icons):
+    refresh_icon_index(wf, type, icons)
+    return icon_record(icons[type][key]) if key in icons[type] else None
+
+def icon_due(record):
+    """Whether an icon should be fetched - failed ones are retried with exponential backoff"""
+    if not record: return True
+    if record['path']: return False
+    delay = min(ICON_RETRY_MAX, ICON_RETRY_BASE * 2 ** (record['failures'] - 1))
+    return time() - record['fetched'] >= delay
+
+def record_icon(wf, type, key, icons, path, url=None):
+    """Save the outcome of a fetch in the icon index and return the path, '' if it failed"""
+    record = icon_record(icons[type][key]) if key in icons[type] else {'failures': 0}
+    icons[type][key] = {'path': path if path else '', 'url': url, 'fetched': time(), 'failures': 0 if path else record['failures'] + 1}
+    if path:
+        # our own download changed the directory, that alone does not need a rescan
+        seen = get_db(wf).metadata('icons.dirs')
+        dir = os.path.dirname(path)
+        seen[dir] = dir_mtime(dir)
+    return icons[type][key]['path']
+
+def cached_icon(wf, type, icon, icons=None, force=False):
+    """The icon already on disk for `icon`, without downloading anything"""
+    icons = get_metadata(wf, 'icons') if not icons else icons
+    if force: refresh_icon_index(wf, type, icons, True)
+    record = lookup_icon(wf, type, icon_key(icon), icons)
+    return record['path'] if record and record['path'] else None
+
+def known_icon(wf, type, id, holder, icons, misses):
+    """Icon for a merchant or bank from what is already on disk - never downloads
+
+    Entries without an icon that are due a fetch are added to `misses` for `queue_icons`.
+    """
+    if not id or id not in holder: return None
+    entry = holder[id]
+    if entry.get('icon') or not entry.get('name'): return entry.get('icon')
+    record = lookup_icon(wf, type, icon_key(entry['name']), icons)
+    if record and record['path']: return record['path']
+    if icon_due(record): misses.append((type, id))
+    return None
+
+def queue_icons(wf, misses):
+    """Hand icons the filter could not show to a background fetch
+
+    The fetch is started even if every miss was queued already - one that
+    was running when they were added may have finished without them.
+    """
+    if not misses: return
+    queue = wf.cached_data(ICON_QUEUE, None, max_age=0) or []
+    added = [x for x in dict.fromkeys(misses) if x not in queue]
+    if added: wf.cache_data(ICON_QUEUE, queue + added)
+    from workflow.background import run_in_background
+    run_in_background('icons', [sys.executable, 'command.py', '--icons'])
+
+def take_icon_queue(wf):
+    queue = wf.cached_data(ICON_QUEUE, None, max_age=0) or []
+    wf.cache_data(ICON_QUEUE, None)
+    return queue
 
 def category_name(wf, category_id, full=False):
-    categories = get_stored_data(wf, 'categories', {})
+    categories = get_metadata(wf, 'categories')
     names = categories[category_id]['list']
     return ','.join(names) if full else names[-1]
 
-def get_bank_icon(wf, institution_id, banks, icons):
-    if not institution_id: return None
-    bank = banks[institution_id]
-    if not 'icon' in bank or not bank['icon']:
-        name = bank['name']
-        logo = bank['logo']
-        banks[institution_id]['icon'] = get_icon(wf, 'bank', name, icons, logo)
-    return banks[institution_id]['icon']
-
-def get_merchant_icon(wf, merchant_id, merchants, icons):
-    if not merchant_id: return None
-    if not 'icon' in merchants[merchant_id]:
-        merchant = merchants[merchant_id]['name']
-        merchant_url = merchants[merchant_id]['logo']
-        merchants[merchant_id]['icon'] = get_icon(wf, 'merchant', merchant, icons, merchant_url)
-    return merchants[merchant_id]['icon']
+def to_date(value):
+    """date of a stored post/auth value, a date or a datetime - None if empty
+
+    Dates are stored as ISO 'YYYY-MM-DD' text. Older databases hold
+    'YYYY-MM-DD 00:00:00', which starts with the same ten characters.
+    """
+    if not value: return None
+    if isinstance(value, datetime): return value.date()
+    if isinstance(value, date): return value
+    return date.fromisoformat(value[:10])
+
+def store_date(value):
+    """ISO text a date is stored and compared as in the transactions table"""
+    value = to_date(value)
+    return value.isoformat() if value else None
+
+def find_category_icon(wf, hierarchy, icons):
+    """Best bundled icon for a category hierarchy, trying the most specific level first"""
+    for cat in reversed(hierarchy):
+        words = re.split(r'\s+|\'|,', cat)
+        # longest leading words first, then longest trailing words
+        for substr in [''.join(words[0:i]) for i in range(len(words), 0, -1)] + [''.join(words[-(i+1):]) for i in range(len(words))]:
+            if not substr: continue
+            if "s" == substr[-1]: substr = substr[:-1]
+            icon = cached_icon(wf, 'category', substr.lower(), icons)
+            if icon: return icon
+    return None
 
 def get_category_icon(wf, category_id, categories, icons):
+    """The icon worked out for the category when categories were last updated"""
     if not category_id: return None
     category_id = int(category_id)
-    if not 'icon' in categories[category_id]:
-        categories[category_id]['icon'] = None
-        cats = categories[category_id]['list']
-        for i in range(len(cats), 0, -1):
-            if categories[category_id]['icon']: break
-            #wf.logger.debug(cats)
-            cat = cats[i-1]
-            words = re.split(r'\s+|\'|,', cat)
-            for i in range(len(words),0,-1):
-                if categories[category_id]['icon']: break
-                substr = ''.join(words[0:i])
-                if "s" == substr[-1]: substr = substr[:-1]
-                icon = get_icon(wf, 'category', substr.lower(), icons)
-                if icon: 
-                    categories[category_id]['icon'] = icon
-            for i in range(len(words)):
-                if categories[category_id]['icon']: break
-                substr = ''.join(words[-(i+1):])
-                if "s" == substr[-1]: substr = substr[:-1]
-                icon = get_icon(wf, 'category', substr.lower(), icons)
-                if icon: 
-                    categories[category_id]['icon'] = icon
-    return categories[category_id]['icon']
+    if category_id not in categories: return None
+    category = categories[category_id]
+    # categories saved before icons were precomputed are worked out once here
+    if 'icon' not in category:
+        category['icon'] = find_category_icon(wf, category['list'], icons)
+        categories[category_id] = category
+    return category['icon']
 
 def get_db_file(wf):
     return wf.datafile(get_environment(wf)+'.db')
 
+def get_db(wf):
+    from db import TxnDB # db imports common
+    file = get_db_file(wf)
+    if file not in DATABASES:
+        DATABASES[file] = TxnDB(file, wf.logger, lambda: run_migrations(wf))
+    return DATABASES[file]
+
+def run_migrations(wf):
+    """Rewrite old data in the background, the filter answers from it as it is meanwhile"""
+    from workflow.background import run_in_background
+    run_in_background('migrate', [sys.executable, 'command.py', '--migrate'])
+
+def get_metadata(wf, name):
+    """merchants, banks and categories as dict-like DB tables, icons as a dict of them by icon type
+
+    Pickles left by older versions are moved into the DB on first use.
+    """
+    db = get_db(wf)
+    if 'icons' == name:
+        tables = {type: db.metadata(f'icons.{type}') for type in ICONS_DEFAULT}
+    else:
+        tables = db.metadata(name, METADATA_KEYS[name])
+    if (db.file, name) not in MIGRATED:
+        MIGRATED.add((db.file, name))
+        legacy = get_stored_data(wf, name, None)
+        if legacy:
+            wf.logger.debug(f'moving {name} into the database')
+            for key in legacy:
+                if 'icons' == name:
+                    tables[key].update(legacy[key])
+                else:
+                    tables[key] = legacy[key]
+            save_metadata(wf, name)
+            set_stored_data(wf, name, None)
+    return tables
+
+def save_metadata(wf, name):
+    tables = get_metadata(wf, name)
+    # directory times are saved with the icons so the index never claims files it has not recorded
+    for table in ([*tables.values(), get_db(wf).metadata('icons.dirs')] if 'icons' == name else [tables]):
+        table.save()
+
 def get_protocol(wf):
     return wf.settings['protocol'] if 'protocol' in wf.settings else SERVER_PROTOCOL
 
+def get_sync_concurrency(wf):
+    return int(wf.settings['sync_concurrency']) if 'sync_concurrency' in wf.settings else SYNC_CONCURRENCY
+
+def get_page_size(wf):
+    return int(wf.settings['page_size']) if 'page_size' in wf.settings else PAGE_SIZE
+
 def get_link_func(wf):
     proto = get_protocol(wf)
     return lambda x: f'{proto}://{SERVER_HOST}:{SERVER_PORT}/link.html?link_token={x}'
@@ -172,74 +321,160 @@ def error(text):
     print(text)
     exit(0)
 
-def get_stored_data(wf, name, default={}):
-    name = f"{get_environment(wf)}.{name}"
+def stored_data_stat(wf, name):
+    try:
+        stat = os.stat(wf.datafile(f"{name}.{wf.data_serializer}"))
+        return (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        return None
+
+def load_data(wf, name):
+    stat = stored_data_stat(wf, name)
+    # only unpickle again if another process has rewritten the file since
+    if name in STORED_DATA and STORED_DATA[name][0] == stat:
+        return STORED_DATA[name][1]
+    data = None
     try:
         data = wf.stored_data(name)
     except ValueError:
         pass
+    STORED_DATA[name] = (stat, data)
+    return data
+
+def save_data(wf, name, data):
+    wf.store_data(name, data)
+    STORED_DATA[name] = (stored_data_stat(wf, name), data)
+
+def get_stored_data(wf, name, default={}):
+    data = load_data(wf, f"{get_environment(wf)}.{name}")
     return data if data else default
 
 def set_stored_data(wf, name, data):
-    name = f"{get_environment(wf)}.{name}"
-    wf.store_data(name, data)
+    save_data(wf, f"{get_environment(wf)}.{name}", data)
 
 def get_current_user(wf):
-    return get_secure_value(wf, 'current_user', None, ALL_USER)
+    return get_local_value(wf, 'current_user', None, ALL_USER)
 
 def set_current_user(wf, user):
-    set_secure_value(wf, 'current_user', user, ALL_USER)
+    set_local_value(wf, 'current_user', user, ALL_USER)
 
-def get_password(wf, name):
-    try:
-        items = wf.get_password(name)
-    except PasswordNotFound:  # Access Token has not yet been set
-        items = '{}'
-    items = json.loads(items)
-    return items
-
-def save_password(wf, name, value):
-    wf.save_password(name, json.dumps(value))
-      
-def get_storage(wf):
+def get_secure_store(wf):
     global STORAGE
-    if not STORAGE: STORAGE = get_password(wf, SECURE_STORE)
+    if not STORAGE: STORAGE = SecureStore(get_backend(wf))
     return STORAGE
 
-def save_storage(wf):
-    global STORAGE
-    save_password(wf, SECURE_STORE, STORAGE)
+def secure_session(wf):
+    """Batch secure store changes into a single write, rolled back on exceptions"""
+    return get_secure_store(wf).session()
+
+def commit_secure_values(wf):
+    """Write the secure store now, for changes that must survive the rest of a session failing"""
+    get_secure_store(wf).commit()
+      
+def get_storage(wf):
+    return get_secure_store(wf).get()
+
+def find_store(storage, user, env, create=False):
+    if env not in storage:
+        if not create: return None
+        storage[env] = {}
+    if user and user not in storage[env]:
+        if not create: return None
+        storage[env][user] = {}
+    return storage[env][user] if user else storage[env]
 
 # global values are under env='global'
 # across user values are under user='config'
 def get_secure_value(wf, key, default=None, user=None, env=None):
     user = user if user else get_current_user(wf)
     env = env if env else get_environment(wf)
-    storage = get_storage(wf)
-    if env not in storage: return default
-    if user and user not in storage[env]: return default
-    store = storage[env][user] if user else storage[env]
-    if key not in store: return default
-    return store[key]
+    store = find_store(get_storage(wf), user, env)
+    return store[key] if store and key in store else default
 
 # global values are under env='global'
 # across user values are under user='config'
 def set_secure_value(wf, key, value, user=None, env=None):
-    global STORAGE
     user = user if user else get_current_user(wf)
     env = env if env else get_environment(wf)
-    if not STORAGE: STORAGE = {}
-    if env not in STORAGE: STORAGE[env] = {}
-    if user and user not in STORAGE[env]: STORAGE[env][user] = {}
-    store = STORAGE[env][user] if user else STORAGE[env]
-    if key not in store: store[key] = {}
+    store = find_store(get_storage(wf), user, env, True)
     store[key] = value
-    save_storage(wf)
+    get_secure_store(wf).changed()
         
 def reset_secure_values(wf):
-    global STORAGE
-    STORAGE = {}
-    save_storage(wf)
+    get_secure_store(wf).reset()
+    save_data(wf, LOCAL_STORE, {LOCAL_VERSION: 1})
+
+def get_local_storage(wf):
+    """Non-secret state laid out like the secure store, kept in the workflow data dir
+
+    Values that older versions kept in the secure store are moved here the
+    first time it is read, after that reading it never touches the keychain.
+    """
+    storage = load_data(wf, LOCAL_STORE)
+    if storage is None:
+        storage = {}
+        STORED_DATA[LOCAL_STORE] = (None, storage)
+    if LOCAL_VERSION not in storage:
+        migrate_secure_values(wf, storage)
+    return storage
+
+def migrate_secure_values(wf, storage):
+    wf.logger.debug('moving account state out of the secure store')
+    secure = get_storage(wf)
+    for env in secure:
+        for user in [x for x in secure[env] if isinstance(secure[env][x], dict)]:
+            store = secure[env][user]
+            local = find_store(storage, user, env, True)
+            for key in [x for x in LOCAL_KEYS if x in store]:
+                local[key] = store.pop(key)
+            if 'items' in local:
+                store['tokens'] = {id: local['items'][id].pop('access_token') for id in local['items'] if 'access_token' in local['items'][id]}
+            for key in [x for x in CREDENTIAL_KEYS if x in store]:
+                local[f'{key}_set'] = True
+    storage[LOCAL_VERSION] = 1
+    save_data(wf, LOCAL_STORE, storage)
+    get_secure_store(wf).changed()
+
+def get_local_value(wf, key, default=None, user=None, env=None):
+    user = user if user else get_current_user(wf)
+    env = env if env else get_environment(wf)
+    store = find_store(get_local_storage(wf), user, env)
+    return store[key] if store and key in store else default
+
+def set_local_value(wf, key, value, user=None, env=None):
+    user = user if user else get_current_user(wf)
+    env = env if env else get_environment(wf)
+    storage = get_local_storage(wf)
+    store = find_store(storage, user, env, True)
+    store[key] = value
+    save_data(wf, LOCAL_STORE, storage)
+
+def set_credential(wf, key, value, user=None, env=None):
+    """Save a credential in the secure store and note locally that it is set"""
+    set_secure_value(wf, key, value, user, env)
+    set_local_value(wf, f'{key}_set', bool(value), user, env)
+
+def has_credential(wf, key, user=None, env=None):
+    """Whether a credential is set, without reading the secure store"""
+    return get_local_value(wf, f'{key}_set', False, user, env)
+
+def get_items(wf, tokens=True):
+    """Linked items, with their access tokens from the secure store if `tokens`
+
+    With `tokens`, items whose token is missing are left out - the local
+    store is written straight away, a rolled back secure session can leave
+    items behind without one.
+    """
+    items = get_local_value(wf, 'items', {})
+    if not tokens: return {id: {**items[id]} for id in items}
+    access = get_secure_value(wf, 'tokens', {})
+    return {id: {**items[id], 'access_token': access[id]} for id in items if id in access}
+
+def set_items(wf, items):
+    tokens = {id: items[id]['access_token'] for id in items if items[id].get('access_token')}
+    if tokens != get_secure_value(wf, 'tokens', {}):
+        set_secure_value(wf, 'tokens', tokens)
+    set_local_value(wf, 'items', {id: {k: v for k, v in items[id].items() if 'access_token' != k} for id in items})
     
 def get_category(wf, txn, custom_cats=None):
     merchant_id = (txn['merchant_entity_id'] if 'merchant_entity_id' in txn else None) if type(txn) is dict else txn['merchant_id']
@@ -255,17 +490,3 @@ def set_category(wf, id, category_id):
     custom_categorization = get_stored_data(wf, 'custom_categorization', {})
     custom_categorization[id] = category_id
     set_stored_data(wf, 'custom_categorization', custom_categorization)
-
-def extract_filter(query, token, type):
-    result = None
-    extract = re.findall(fr"{token}\:([^\s]+) ",query)
-    if extract:
-        result = extract[0]
-        query = query.replace(f"{token}:{result}",'').replace(r'\s+',' ')
-        if('date' == type):
-            result = parse(result)
-        elif('number' == type):
-            result = int(result)
-        elif('text' == type):
-            pass
-    return query,result
\ No newline at end of file
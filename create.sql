@@ -26,15 +26,31 @@ CREATE VIRTUAL TABLE IF NOT EXISTS txn_fts USING fts5(
 );
 CREATE INDEX IF NOT EXISTS txn_post_idx on transactions(post);
 CREATE INDEX IF NOT EXISTS txn_amount_idx on transactions(amount);
+CREATE INDEX IF NOT EXISTS txn_account_post_idx on transactions(account_id, post);
+CREATE INDEX IF NOT EXISTS txn_category_post_idx on transactions(category_id, post);
+
+/* merchants, banks, categories and icons as JSON, looked up by id */
+CREATE TABLE IF NOT EXISTS metadata(
+    kind text,
+    id text,
+    data text,
+    primary key (kind, id)
+) WITHOUT ROWID;
+
+/* last committed /transactions/sync cursor per item */
+CREATE TABLE IF NOT EXISTS sync_cursors(
+    item_id text primary key,
+    cursor text
+);
 
 /* triggers to keep the FTS tables up to date */
-CREATE TRIGGER txn_ai AFTER INSERT ON transactions BEGIN
+CREATE TRIGGER IF NOT EXISTS txn_ai AFTER INSERT ON transactions BEGIN
   INSERT INTO txn_fts(rowid, subtype, merchant, institution, categories) VALUES (new.id, new.subtype, new.merchant, new.institution, new.categories);
 END;
-CREATE TRIGGER txn_ad AFTER DELETE ON transactions BEGIN
+CREATE TRIGGER IF NOT EXISTS txn_ad AFTER DELETE ON transactions BEGIN
   INSERT INTO txn_fts(txn_fts, rowid, subtype, merchant, institution, categories) VALUES ('delete', old.id, old.subtype, old.merchant, old.institution, old.categories);
 END;
-CREATE TRIGGER txn_au AFTER UPDATE ON transactions BEGIN
+CREATE TRIGGER IF NOT EXISTS txn_au AFTER UPDATE OF subtype, merchant, institution, categories ON transactions BEGIN
   INSERT INTO txn_fts(txn_fts, rowid, subtype, merchant, institution, categories) VALUES ('delete', old.id, old.subtype, old.merchant, old.institution, old.categories);
   INSERT INTO txn_fts(rowid, subtype, merchant, institution, categories) VALUES (new.id, new.subtype, new.merchant, new.institution, new.categories);
 END;
@@ -0,0 +1,155 @@
+import os
+import io
+import sys
+import json
+import socket
+import hashlib
+import tempfile
+
+IDLE_TIMEOUT = 300 # seconds without a query before the daemon exits
+CONNECT_TIMEOUT = 1
+REPLY_TIMEOUT = 30
+DAEMON_NAME = 'filterd'
+
+# only the standard library is imported up here - the client side runs on every keystroke
+
+def socket_path():
+    """Socket for this workflow, None where there is no workflow cache dir or no Unix sockets
+
+    It lives in the temp dir because the cache dir path is too long for a socket name on macOS.
+    """
+    cache = os.environ.get('alfred_workflow_cache')
+    if not cache or not hasattr(socket, 'AF_UNIX'): return None
+    digest = hashlib.sha1(cache.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(tempfile.gettempdir(), f'alfred-plaid-{os.getuid()}-{digest}.sock')
+
+def read_all(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk: break
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+def forward(args):
+    """Have a running daemon answer the query and print its reply
+
+    Returns False if there was no daemon to answer, after starting one for
+    the next query, so the caller should answer this one itself.
+    """
+    path = socket_path()
+    # magic arguments act on the workflow itself so they always run in the calling process
+    if not path or any('workflow:' in x for x in args): return False
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(CONNECT_TIMEOUT)
+            sock.connect(path)
+            sock.settimeout(REPLY_TIMEOUT)
+            sock.sendall(json.dumps({'args': args}).encode('utf-8'))
+            sock.shutdown(socket.SHUT_WR)
+            reply = json.loads(read_all(sock).decode('utf-8'))
+    except (OSError, ValueError):
+        start()
+        return False
+    if not reply.get('ok'): return False
+    sys.stdout.write(reply['output'])
+    sys.stdout.flush()
+    return True
+
+def start():
+    from workflow.background import run_in_background
+    run_in_background(DAEMON_NAME, [sys.executable, os.path.abspath(__file__)])
+
+class Daemon:
+    """Answers script filter queries over a Unix socket from one long-lived process
+
+    The database, metadata and icon index stay loaded between queries. They
+    are dropped whenever the database files change under us, which is what
+    a sync or a recategorization in another process does.
+    """
+    def __init__(self, path):
+        import filter
+        import common
+        from workflow import Workflow
+        self.path = path
+        self.filter = filter
+        self.common = common
+        self.Workflow = Workflow
+        self.stamps = {}
+
+    def stamp(self, file):
+        result = []
+        for name in [file, f'{file}-wal']:
+            try:
+                stat = os.stat(name)
+                result.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                result.append(None)
+        return tuple(result)
+
+    def refresh(self, wf):
+        """Drop the database if its files changed since the last query, returns the file and its new stamp
+
+        The stamp is taken before the query is answered, so anything written
+        while it is, by us or another process, counts as a change next time.
+        """
+        file = self.common.get_db_file(wf)
+        if file in self.stamps and self.stamps[file] != self.stamp(file):
+            wf.logger.debug(f'daemon: {file} changed, reloading')
+            db = self.common.DATABASES.pop(file, None)
+            if db: db.close()
+            self.common.CHECKED_DIRS.clear()
+        # opening the database creates its WAL again after a close, that is not a change
+        self.common.get_db(wf).connect()
+        return file, self.stamp(file)
+
+    def answer(self, args):
+        sys.argv = ['filter.py', *args]
+        wf = self.Workflow(libraries=['./lib'])
+        file, stamp = self.refresh(wf)
+        out = io.StringIO()
+        stdout = sys.stdout
+        sys.stdout = out
+        try:
+            self.filter.wf = wf
+            self.filter.log = wf.logger
+            self.filter.main(wf)
+        except Exception as e:
+            wf.logger.exception(e)
+            return {'ok': False}
+        finally:
+            sys.stdout = stdout
+            self.stamps[file] = stamp
+        return {'ok': True, 'output': out.getvalue()}
+
+    def serve(self):
+        if os.path.exists(self.path): os.unlink(self.path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            # bound under a temporary name so clients never find a socket that isn't listening yet
+            bound = f'{self.path}.{os.getpid()}'
+            if os.path.exists(bound): os.unlink(bound)
+            server.bind(bound)
+            os.chmod(bound, 0o600)
+            server.listen(8)
+            os.replace(bound, self.path)
+            server.settimeout(IDLE_TIMEOUT)
+            while True:
+                try:
+                    con, _ = server.accept()
+                except socket.timeout:
+                    break
+                with con:
+                    try:
+                        con.settimeout(REPLY_TIMEOUT)
+                        request = json.loads(read_all(con).decode('utf-8'))
+                        con.sendall(json.dumps(self.answer(request['args'])).encode('utf-8'))
+                    except (OSError, ValueError):
+                        pass
+        finally:
+            server.close()
+            if os.path.exists(self.path): os.unlink(self.path)
+
+if __name__ == u"__main__":
+    path = socket_path()
+    if path: Daemon(path).serve()
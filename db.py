@@ -1,23 +1,172 @@
 import sqlite3
-import os
+import json
+from collections.abc import MutableMapping
 from time import time
-import struct
 from datetime import datetime, timedelta
-from dateutil.relativedelta import relativedelta
-from common import extract_filter, get_category, category_name
+from common import get_category, category_name, store_date, to_date
+from query import Query, parse_query
 import re
 
+TXN_COLUMNS = ['transaction_id', 'account_id', 'currency', 'post', 'auth', 'channel', 'amount', 'subtype', 'merchant', 'merchant_id', 'categories', 'category_id', 'txntext']
+INSERT_TXN = f"""INSERT OR IGNORE INTO transactions ({', '.join(TXN_COLUMNS)})
+                VALUES ({', '.join(['?'] * len(TXN_COLUMNS))})"""
+UPSERT_TXN = f"""INSERT INTO transactions ({', '.join(TXN_COLUMNS)})
+                VALUES ({', '.join(['?'] * len(TXN_COLUMNS))})
+                ON CONFLICT(transaction_id) DO UPDATE SET {', '.join([f"{x}=excluded.{x}" for x in TXN_COLUMNS[1:]])}"""
+DELETE_TXN = "DELETE FROM transactions WHERE transaction_id=?"
+# counts every change to the data so cached search results know when they are stale
+BUMP_GENERATION = "INSERT INTO metadata (kind, id, data) VALUES ('db', 'generation', '1') ON CONFLICT(kind, id) DO UPDATE SET data = data + 1"
+SAVE_CURSOR = "INSERT OR REPLACE INTO sync_cursors (item_id, cursor) VALUES (?, ?)"
+SAVE_METADATA = "INSERT OR REPLACE INTO metadata (kind, id, data) VALUES (?, ?, ?)"
+
+# bm25 weights for the txn_fts columns - subtype, merchant, institution, categories
+RANK_WEIGHTS = (1.0, 2.0, 0.5, 0.5)
+# column each srt: value sorts on, qualified since txn_fts has a merchant column too
+SORT_COLUMNS = {'post': 't.post', 'amount': 't.amount', 'merchant': 't.merchant', 'txntext': 't.txntext'}
+# age in days at which a match counts half as relevant when sorting with srt:rank
+RANK_HALF_LIFE = 180
+
+# numbered schema changes, applied in order at open to databases older than them.
+# create.sql always holds the latest schema so a new database starts at the last version.
+# never renumber or edit a step once it has shipped - add a new one.
+# (version, method, batched) - batched steps rewrite data and run a range of ids at a time
+MIGRATIONS = [
+    (3, 'migrate_objects', False),
+    (4, 'migrate_fts_trigger', False),
+    (5, 'migrate_iso_dates', True)
+]
+# ids rewritten per transaction by batched migrations, so a sync or the filter can get in between
+MIGRATION_BATCH = 5000
+
+# applied to every new connection - WAL lets the script filter read while a sync writes
+PRAGMAS = [
+    'journal_mode=WAL',
+    'synchronous=NORMAL',
+    'cache_size=-8000',  # in KiB
+    'mmap_size=67108864',
+    'temp_store=MEMORY',
+    'busy_timeout=5000'
+]
+
+class MetaTable(MutableMapping):
+    """Dict-like view of one kind of metadata (merchants, banks, categories, icons)
+
+    Rows are read by id on first access and cached, iterating loads the rest in
+    one query, and `save` upserts only the rows whose value changed since they
+    were read - including changes made in place to a returned dict.
+    """
+    def __init__(self, db, kind, key_type=str):
+        self.db = db
+        self.kind = kind
+        self.key_type = key_type
+        self.rows = {}  # key -> [json as stored or None if not stored, value]
+        self.complete = False
+
+    def __getitem__(self, key):
+        key = self.key_type(key)
+        if key not in self.rows:
+            row = None if self.complete else self.db.connect().execute("SELECT data FROM metadata WHERE kind=? AND id=?", (self.kind, str(key))).fetchone()
+            if row is None: raise KeyError(key)
+            self.rows[key] = [row['data'], json.loads(row['data'])]
+        return self.rows[key][1]
+
+    def __setitem__(self, key, value):
+        key = self.key_type(key)
+        stored = self.rows[key][0] if key in self.rows else None
+        self.rows[key] = [stored, value]
+
+    def __delitem__(self, key):
+        key = self.key_type(key)
+        if key not in self: raise KeyError(key)
+        con = self.db.connect()
+        with con:
+            con.execute("DELETE FROM metadata WHERE kind=? AND id=?", (self.kind, str(key)))
+            con.execute(BUMP_GENERATION)
+        del self.rows[key]
+
+    def load(self):
+        if not self.complete:
+            for row in self.db.connect().execute("SELECT id, data FROM metadata WHERE kind=?", (self.kind,)):
+                key = self.key_type(row['id'])
+                if key not in self.rows:
+                    self.rows[key] = [row['data'], json.loads(row['data'])]
+            self.complete = True
+        return self
+
+    def __iter__(self):
+        return iter(list(self.load().rows.keys()))
+
+    def __len__(self):
+        if self.complete: return len(self.rows)
+        ids = {self.key_type(row['id']) for row in self.db.connect().execute("SELECT id FROM metadata WHERE kind=?", (self.kind,))}
+        return len(ids | set(self.rows.keys()))
+
+    def changes(self):
+        """(kind, id, data) for the rows that were added or changed since they were read or saved"""
+        changed = []
+        for key, row in self.rows.items():
+            data = json.dumps(row[1])
+            if data != row[0]: changed.append((self.kind, str(key), data))
+        return changed
+
+    def saved(self, changed):
+        """Note the rows from `changes` as stored, once the transaction writing them has committed"""
+        for _, key, data in changed:
+            self.rows[self.key_type(key)][0] = data
+
+    def save(self):
+        """Upsert the rows that were added or changed, returns how many were written"""
+        changed = self.changes()
+        if changed:
+            con = self.db.connect()
+            with con:
+                con.executemany(SAVE_METADATA, changed)
+                con.execute(BUMP_GENERATION)
+            self.saved(changed)
+            self.db.debug(f"saved {len(changed)} {self.kind} rows")
+        return len(changed)
+
 class TxnDB:
-    def __init__(self, file, logger=None):
+    def __init__(self, file, logger=None, defer=None):
+        """`defer` is called instead of running batched migrations on open, to run them elsewhere"""
         self.file = file
         self.logger = logger
-        if not os.path.exists(self.file):
-            self.create_db()
-                 
+        self.defer = defer
+        self.con = None
+        self.tables = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def debug(self, text):
         if(self.logger): self.logger.debug(text)
+
+    def connect(self):
+        """Return the long-lived connection, opening and tuning it on first use"""
+        if not self.con:
+            self.con = sqlite3.connect(self.file)
+            self.con.row_factory = sqlite3.Row
+            for pragma in PRAGMAS:
+                self.con.execute(f"PRAGMA {pragma}")
+            self.migrate(self.con, self.defer is None)
+        return self.con
+
+    def close(self):
+        if self.con:
+            # refreshes the planner statistics the indexes are chosen from, cheap when nothing changed
+            self.con.execute("PRAGMA optimize")
+            self.con.close()
+            self.con = None
         
-    def create_db(self):
+    def metadata(self, kind, key_type=str):
+        if kind not in self.tables:
+            self.tables[kind] = MetaTable(self, kind, key_type)
+        return self.tables[kind]
+
+    def create_db(self, con):
         """Create a "virtual" table, which sqlite3 uses for its full-text search
 
         Given the size of the original data source (~45K entries, 5 MB), we'll put
@@ -29,39 +178,112 @@ class TxnDB:
         dataset.
         """
         self.debug('Creating transactions database')
+        self.migrate_objects(con)
+        con.execute(f"PRAGMA user_version={MIGRATIONS[-1][0]}")
+
+    def version(self, con):
+        return con.execute("PRAGMA user_version").fetchone()[0]
+
+    def migrate(self, con, batched=True):
+        """Bring the schema up to date, running each pending migration in order
+
+        Every step is safe to run twice, so two processes opening an old
+        database at the same time only repeat work. The version is only
+        ever raised, once a step has finished. Without `batched`, migrating
+        stops at the first batched step and `defer` is called to run it -
+        the steps after it wait until it is done.
+        """
+        version = self.version(con)
+        if version >= MIGRATIONS[-1][0]: return
+        if not con.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='transactions'").fetchone():
+            return self.create_db(con)
+        for number, step, batch in MIGRATIONS:
+            if number <= version: continue
+            if batch and not batched:
+                self.debug(f"deferring migration to version {number}")
+                if self.defer: self.defer()
+                return
+            start = time()
+            if batch:
+                self.run_batched(con, number, getattr(self, step))
+            else:
+                getattr(self, step)(con)
+            if self.version(con) < number: con.execute(f"PRAGMA user_version={number}")
+            self.debug(f"migrated transactions database to version {number} in {(time() - start):0.3f} seconds")
+
+    def run_batched(self, con, number, step):
+        """Run `step` over the transactions a range of MIGRATION_BATCH ids at a time
+
+        Each range is committed together with how far the step got, so
+        readers and writers get in between ranges and an interrupted run
+        carries on where it stopped.
+        """
+        progress = f'migration.{number}'
+        row = con.execute("SELECT data FROM metadata WHERE kind='db' AND id=?", (progress,)).fetchone()
+        first = int(row['data']) if row else 0
+        top = con.execute("SELECT MAX(id) FROM transactions").fetchone()[0] or 0
+        changed = 0
+        while first < top:
+            last = first + MIGRATION_BATCH
+            with con:
+                changed += step(con, first, last)
+                con.execute("INSERT OR REPLACE INTO metadata (kind, id, data) VALUES ('db', ?, ?)", (progress, str(last)))
+            first = last
+        with con:
+            con.execute("DELETE FROM metadata WHERE kind='db' AND id=?", (progress,))
+            if changed: con.execute(BUMP_GENERATION)
+            # in the same transaction as the cleanup, so the step is either finished or resumable
+            if self.version(con) < number: con.execute(f"PRAGMA user_version={number}")
+        self.debug(f"migration to version {number} changed {changed} transactions")
+
+    def migrate_objects(self, con):
+        """Create whatever create.sql has that the database is missing - the schema before numbered migrations"""
         sqlfile = open('create.sql','r')
         sql = sqlfile.read()
         sqlfile.close()
-        con = sqlite3.connect(self.file)
+        con.executescript(sql)
+
+    def migrate_fts_trigger(self, con):
+        """Only reindex a transaction for search when one of its searched columns changes"""
         with con:
-            cur = con.cursor()
-            cur.executescript(sql)
+            con.execute("DROP TRIGGER IF EXISTS txn_au")
+            con.execute("""CREATE TRIGGER txn_au AFTER UPDATE OF subtype, merchant, institution, categories ON transactions BEGIN
+                INSERT INTO txn_fts(txn_fts, rowid, subtype, merchant, institution, categories) VALUES ('delete', old.id, old.subtype, old.merchant, old.institution, old.categories);
+                INSERT INTO txn_fts(rowid, subtype, merchant, institution, categories) VALUES (new.id, new.subtype, new.merchant, new.institution, new.categories);
+            END""")
+
+    def migrate_iso_dates(self, con, first, last):
+        """Rewrite 'YYYY-MM-DD 00:00:00' dates stored by older versions as ISO dates, for ids in (first, last]"""
+        return con.execute("""UPDATE transactions SET post=substr(post, 1, 10), auth=substr(auth, 1, 10)
+            WHERE id > ? AND id <= ? AND (length(post) > 10 OR length(auth) > 10)""", (first, last)).rowcount
             
     def update_txn_category(self, category_id, merchant_id, merchant, txntext, cat_name):
         column_value = merchant_id if merchant_id else (merchant if merchant else txntext)
         params = {'category_id': int(category_id), 'categories': cat_name, 'column_value': column_value}
         column = 'merchant_id' if merchant_id else ('merchant' if merchant else 'txntext')
-        con = sqlite3.connect(self.file)
+        con = self.connect()
         with con:
             cur = con.cursor()
             sql = f"""UPDATE transactions SET category_id=:category_id, categories=:categories
                             WHERE {column}=:column_value"""
             self.logger.debug(f"{sql}: {column} {column_value}")
             cur.execute(sql, params,)
+            cur.execute(BUMP_GENERATION)
             
     def del_account_txns(self, account_id):
         params = {'account_id': account_id}
-        con = sqlite3.connect(self.file)
+        con = self.connect()
         with con:
             cur = con.cursor()
             sql = f"""DELETE from transactions WHERE account_id=:account_id"""
             self.logger.debug(f"{sql}: {account_id}")
             cur.execute(sql, params,)
+            cur.execute(BUMP_GENERATION)
 
-    def save_txn(self, txn, wf):
+    def txn_row(self, txn, wf):
         account_id = txn['account_id']
-        auth = datetime.strptime(txn['authorized_date'], '%Y-%m-%d') if 'authorized_date' in txn and txn['authorized_date'] else None
-        post = datetime.strptime(txn['date'], '%Y-%m-%d')
+        auth = store_date(txn['authorized_date']) if 'authorized_date' in txn else None
+        post = store_date(txn['date'])
         amount = txn['amount']
         category_id = get_category(wf, txn)
         categories = category_name(wf, category_id, True)
@@ -72,41 +294,74 @@ class TxnDB:
         txntext = txn['name']
         subtype = txn['subtype'] if 'subtype' in txn else ''
         txn_id = txn['transaction_id']
-        con = sqlite3.connect(self.file)
+        return (txn_id, account_id, currency, post, auth, channel, amount, subtype, merchant, merchant_id, categories, category_id, txntext)
+
+    def save_txn(self, txn, wf):
+        return self.save_txns([txn], wf)
+
+    def save_txns(self, txns, wf):
+        """Insert transactions in bulk using a single connection and transaction
+
+        Rows that already exist (same transaction_id) are ignored.
+        Returns a tuple of (inserted, ignored) counts.
+        """
+        rows = [self.txn_row(txn, wf) for txn in txns]
+        if not rows: return 0, 0
+        start = time()
+        con = self.connect()
         with con:
-            cur = con.cursor()
-            cur.execute("""INSERT OR IGNORE INTO
-                        transactions (transaction_id, account_id, currency, post, auth, channel, amount, subtype, merchant, merchant_id, categories, category_id, txntext)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                        """, (txn_id, account_id, currency, post, auth, channel, amount, subtype, merchant, merchant_id, categories, category_id, txntext))
+            # rowcount sums the rows actually inserted, ignored duplicates are not counted
+            inserted = con.executemany(INSERT_TXN, rows).rowcount
+            if inserted: con.execute(BUMP_GENERATION)
+        self.debug(f"{inserted} inserted, {len(rows) - inserted} ignored of {len(rows)} transactions in {(time() - start):0.3f} seconds")
+        return inserted, len(rows) - inserted
+
+    def generation(self):
+        """Number of changes made to the data so far, by any process"""
+        row = self.connect().execute("SELECT data FROM metadata WHERE kind='db' AND id='generation'").fetchone()
+        return int(row['data']) if row else 0
 
+    def get_cursor(self, item_id):
+        row = self.connect().execute("SELECT cursor FROM sync_cursors WHERE item_id=?", (item_id,)).fetchone()
+        return row['cursor'] if row else None
 
-    # Search ranking function
-    # Adapted from http://goo.gl/4QXj25 and http://goo.gl/fWg25i
-    def make_rank_func(self, weights):
-        """`weights` is a list or tuple of the relative ranking per column.
+    def apply_sync(self, page, wf, item_id=None, tables=()):
+        """Apply one /transactions/sync page in a single DB transaction
 
-        Use floats (1.0 not 1) for more accurate results. Use 0 to ignore a
-        column.
+        `added` rows are inserted, `modified` rows are upserted and `removed`
+        transaction ids are deleted. Returns a dict of counts for each.
+        If `item_id` is given, the page's `next_cursor` is saved in the same
+        transaction so an interrupted sync resumes after the last saved page.
+        Changed rows of the MetaTables in `tables`, like the merchants the
+        page added, are saved in it too - the page is never fetched again.
         """
-        def rank(matchinfo):
-            # matchinfo is defined as returning 32-bit unsigned integers
-            # in machine byte order
-            # http://www.sqlite.org/fts3.html#matchinfo
-            # and struct defaults to machine byte order
-            bufsize = len(matchinfo)  # Length in bytes.
-            matchinfo = [struct.unpack(b'I', matchinfo[i:i + 4])[0]
-                        for i in range(0, bufsize, 4)]
-            it = iter(matchinfo[2:])
-            return sum(x[0] * w / x[1]
-                    for x, w in zip(zip(it, it, it), weights)
-                    if x[1])
-        return rank
-        
+        added = [self.txn_row(txn, wf) for txn in page.get('added', [])]
+        modified = [self.txn_row(txn, wf) for txn in page.get('modified', [])]
+        removed = [(txn['transaction_id'],) for txn in page.get('removed', [])]
+        changed = [(table, table.changes()) for table in tables]
+        start = time()
+        con = self.connect()
+        with con:
+            counts = {
+                'added': con.executemany(INSERT_TXN, added).rowcount if added else 0,
+                'modified': con.executemany(UPSERT_TXN, modified).rowcount if modified else 0,
+                'removed': con.executemany(DELETE_TXN, removed).rowcount if removed else 0
+            }
+            for table, rows in changed:
+                if rows: con.executemany(SAVE_METADATA, rows)
+            if item_id and page.get('next_cursor'):
+                con.execute(SAVE_CURSOR, (item_id, page['next_cursor']))
+            if any(counts.values()) or any(rows for _, rows in changed): con.execute(BUMP_GENERATION)
+        for table, rows in changed:
+            table.saved(rows)
+        self.debug(f"sync page applied {counts} in {(time() - start):0.3f} seconds")
+        return counts
+
     def parse_dt(self, dt):
         date_from = None
         date_to = None
         if not dt: return date_from, date_to
+        from dateutil.relativedelta import relativedelta
         dt = dt.lower().split('-')
         if len(dt) > 1:
             now = datetime.now()
@@ -144,24 +399,32 @@ class TxnDB:
                     date_to = date_from + relativedelta(years=1, days=-1)
         return date_from, date_to
     
-    def get_results(self, query):
-        self.debug(f"DB query is: {query}")
-        query, date_from = extract_filter(query, 'dtf', 'date')
-        query, date_to = extract_filter(query, 'dtt', 'date')
-        query, amt_from = extract_filter(query, 'amtf', 'number')
-        query, amt_to = extract_filter(query, 'amtt', 'number')
-        query, sort = extract_filter(query, 'srt', 'text')
-        query, order = extract_filter(query, 'ord', 'text')
-        query, acct = extract_filter(query, 'act', 'text')
-        query, dt = extract_filter(query, 'dt', 'text')
-        query, cat = extract_filter(query, 'cat', 'text')
-        query, txn = extract_filter(query, 'txn', 'text')
-        query = query.strip()
+    def plan(self, query, summary=False):
+        """Turn a search query into the SQL and params that answer it
+
+        Every filter maps onto an indexed column - post, amount, transaction_id,
+        (account_id, post) and (category_id, post) - and search terms are joined
+        from the FTS table rather than matched through an IN subquery.
+        With `summary` the SQL counts and totals the matches instead of listing them.
+        Returns (None, None) if the query has nothing to search on.
+        """
+        q = query if isinstance(query, Query) else parse_query(query)
+        date_from = q.get('dtf')
+        date_to = q.get('dtt')
+        amt_from = q.get('amtf')
+        amt_to = q.get('amtt')
+        sort = q.get('srt')
+        order = q.get('ord')
+        accts = list(q.get('act', []))
+        dt = q.get('dt')
+        cat = q.get('cat')
+        txn = q.get('txn')
         self.debug(f"txn is {txn} and cat is {cat}")
         if dt:
             dfro, dto = self.parse_dt(dt)
             date_from = dfro if dfro and not date_from else date_from
             date_to = dto if dto and not date_to else date_to
+        max_cat = 0
         if cat:
             if re.match(r'^\d+$', cat):
                 pat = re.compile(r'([0-9]*)([1-9])(0+)$')
@@ -170,51 +433,86 @@ class TxnDB:
                 max_cat = int(groups[1]+str(int(groups[2])+1)+groups[3]) if groups else cat+1
             else:
                 cat = None
-        else:
-            max_cat = 0
         sort = sort if sort else 'post'
         order = order if order else 'DESC'
+        if 'rank' == sort and q.match:
+            # bm25 scores are negative, best first - negated and scaled down with age so higher is more relevant.
+            # equally relevant matches show the most recent first whatever the order
+            sort = f"-relevance / (1 + (julianday('now') - julianday(t.post)) / {RANK_HALF_LIFE}) {order}, t.post DESC, t.id DESC"
+        else:
+            # without search terms nothing is more relevant than anything else, rank sorts by date
+            # ties, like transactions posted the same day, are broken by id so LIMIT/OFFSET pages never overlap
+            sort = f"{SORT_COLUMNS['post' if 'rank' == sort else sort]} {order}, t.id {order}"
         dtf = f" AND post >= :dtf" if date_from else ''
-        dtt = f" AND post <= :dtt" if date_to else ''
+        # dates compare as text, the day after the last one keeps the whole of it in range
+        dtt = f" AND post < :dtt" if date_to else ''
         amtf = f" AND amount >= :amtf" if amt_from else ''
         amtt = f" AND amount <= :amtt" if amt_to else ''
-        acctq = f" AND account_id IN (:acct)" if acct else ''
+        # one bound parameter per account so the set can be matched against the account index
+        acctq = f" AND account_id IN ({', '.join([f':acct{i}' for i in range(len(accts))])})" if accts else ''
         catq = f" AND category_id >= :cat AND category_id < :max_cat" if cat else ''
         txnq = f" AND transaction_id = :txn" if txn else ''
         catq = catq if not txn else '' # if txn_id is specified cat is ignored
-        termsearch = f"id IN (SELECT rowid from txn_fts WHERE txn_fts MATCH :query ORDER BY rank DESC)"
-        query = ' '.join([x+'*' if ':' not in x else '' for x in query.strip().split()]).strip()
-        params = {'query': query, 'amtt': amt_to, 'amtf': amt_from, 'dtt': date_to, 'dtf': date_from, 'srt': sort, 'ord': order, 'acct': acct, 'cat': cat, 'max_cat': max_cat, 'txn': txn}
-        termsearch = termsearch if query else 'id IS NOT NULL'
+        query = q.match
+        params = {'query': query, 'amtt': amt_to, 'amtf': amt_from, 'dtt': store_date(to_date(date_to) + timedelta(days=1)) if date_to else None, 'dtf': store_date(date_from), 'srt': sort, 'ord': order, 'cat': cat, 'max_cat': max_cat, 'txn': txn}
+        params.update({f'acct{i}': x for i, x in enumerate(accts)})
+        if query:
+            # join the FTS matches so the native bm25 score can be used for ordering
+            source = "txn_fts JOIN transactions t ON t.id = txn_fts.rowid"
+            relevance = f"bm25(txn_fts, {', '.join([str(x) for x in RANK_WEIGHTS])})"
+            termsearch = "txn_fts MATCH :query"
+        else:
+            source = "transactions t"
+            relevance = "0"
+            termsearch = "t.id IS NOT NULL"
         self.debug(params)
-        if not (query or dtf or dtt or amtf or amtt or catq or txnq): return None
-            
-        # Search!
-        start = time()
-        db = sqlite3.connect(self.file)
-        db.row_factory = sqlite3.Row
-        # Set ranking function with weightings for each column.
-        # `make_rank_function` must be called with a tuple/list of the same
-        # length as the number of columns "selected" from the database.
-        # In this case, `url` is set to 0 because we don't want to search on
-        # that column
-        db.create_function('rank', 1, self.make_rank_func((1.0, 1.0, 0, 0)))
-        cursor = db.cursor()
+        if not (query or dtf or dtt or amtf or amtt or catq or txnq): return None, None
+        where = f"WHERE {termsearch}{dtt}{dtf}{amtt}{amtf}{catq}{acctq}{txnq}"
+        if summary:
+            return f"SELECT COUNT(*) AS count, COALESCE(SUM(t.amount), 0) AS total FROM {source} {where}", params
+        sql = f"""
+                SELECT t.transaction_id, t.account_id, t.txntext, t.subtype, t.merchant, t.merchant_id, t.post, t.currency, t.amount, t.category_id, t.categories, {relevance} AS relevance
+                FROM {source}
+                {where} ORDER BY {sort}"""
+        return sql, params
+
+    def explain(self, query):
+        """Return the EXPLAIN QUERY PLAN details for a search query"""
+        sql, params = self.plan(query)
+        if not sql: return []
+        return [row['detail'] for row in self.connect().execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+
+    def search(self, sql, params):
         try:
-            sql = f"""
-                    SELECT transaction_id, account_id, txntext, subtype, merchant, merchant_id, post, currency, amount, category_id, categories 
-                    FROM transactions 
-                    WHERE {termsearch}{dtt}{dtf}{amtt}{amtf}{catq}{acctq}{txnq} ORDER BY {sort} {order}"""
             self.debug(sql)
-            cursor.execute(sql, params, )
-            results = cursor.fetchall()
+            return self.connect().execute(sql, params).fetchall()
         except sqlite3.OperationalError as err:
             # If the query is invalid, show an appropriate warning and exit
-            if b'malformed MATCH' in err:
-                self.debug(f'Invalid Query {query}')           # Otherwise raise error for Workflow to catch and log
+            if params.get('query') and ('fts5' in str(err) or 'malformed MATCH' in str(err)):
+                self.debug(f"Invalid Query {params['query']}")           # Otherwise raise error for Workflow to catch and log
+                return []
             else:
                 raise err
+
+    def get_results(self, query, limit=None, offset=0):
+        """Matching transactions, only the `limit` rows after `offset` if a limit is given"""
+        self.debug(f"DB query is: {query}")
+        sql, params = self.plan(query)
+        if not sql: return None
+        if limit:
+            sql = f"{sql} LIMIT :limit OFFSET :offset"
+            params = {**params, 'limit': limit, 'offset': offset}
             
+        # Search!
+        start = time()
+        results = self.search(sql, params)
         self.debug('{} results for `{}` in {:0.3f} seconds'.format(
-                len(results), query, time() - start))
-        return results
\ No newline at end of file
+                len(results), params['query'], time() - start))
+        return results
+
+    def get_summary(self, query):
+        """Count and total of every transaction matching the query, however many are shown"""
+        sql, params = self.plan(query, True)
+        if not sql: return None
+        results = self.search(sql, params)
+        return results[0] if results else None
@@ -1,18 +1,21 @@
 # encoding: utf-8
 
 import sys
+
+if __name__ == u"__main__":
+    # a running daemon answers without this process loading anything else
+    from daemon import forward
+    if forward(sys.argv[1:]): sys.exit(0)
+
 import argparse
 from workflow.workflow import MATCH_ATOM, MATCH_STARTSWITH, MATCH_SUBSTRING, MATCH_ALL, MATCH_INITIALS, MATCH_CAPITALS, MATCH_INITIALS_STARTSWITH, MATCH_INITIALS_CONTAIN
 from workflow import Workflow, ICON_NOTE, ICON_BURN, PasswordNotFound
-from common import get_stored_data, get_environment, get_protocol, get_secure_value, set_secure_value, get_current_user, ALL_ENV, ALL_USER, get_db_file, get_category_icon, get_category, extract_filter, get_merchant_icon, get_bank_icon, get_category_icon, ICONS_DEFAULT
-from db import TxnDB
-from dateutil.parser import parse 
+from common import get_stored_data, get_metadata, get_db, get_environment, get_protocol, get_items, get_local_value, has_credential, get_current_user, ALL_ENV, ALL_USER, get_category_icon, get_category, known_icon, queue_icons, get_page_size, stored_data_stat, to_date, LOCAL_STORE
+from query import parse_query
 from datetime import timedelta, datetime
 import re
 import os
 import json
-import urllib.parse
-from dateutil.parser import parse 
 from shlex import quote
 
 log = None
@@ -23,17 +26,20 @@ time_aggregates = {'d': 'day', 'w': 'week', 'm': 'month'}
 merchant_aggregates = {'m': 'merchant', 'c': 'category'}
 timeframes = ['This week', 'This month', 'This quarter', 'This half', 'This year', 'Last week', 'Last month', 'Last quarter', 'Last half', 'Last year']
 
-chart_options = {
+chart_defaults = {
     'ta': 'm', # time aggregation
     'ma': 'm', # merchant/category aggregation
     'ct': 'b' # chart type
 }
+chart_options = dict(chart_defaults)
+RESULTS_CACHE = 'results'
+RESULTS_CACHE_SIZE = 32
 
 def get_time_cut(dt, ta, ct):
     if ct in ['p', 'd']: return 'all'
     if 'd' == ta: return dt.strftime('%b-%d-%y')
     if 'w' == ta: return (dt - timedelta(days=dt.isoweekday() % 7)).strftime('%b-%d-%y')
-    if 'm' == ta: return dt.replace(day=1,hour=0,minute=0,second=0).strftime('%b-%y')
+    if 'm' == ta: return dt.replace(day=1).strftime('%b-%y')
 
 def create_chart(wf, txns): 
     ta = chart_options['ta']
@@ -44,11 +50,10 @@ def create_chart(wf, txns):
     lines = ['Total'] if ct not in ['p','d'] else []
     min_date = None
     max_date = None
-    merchants = get_stored_data(wf, 'merchants')
-    categories = get_stored_data(wf, 'categories')
+    categories = get_metadata(wf, 'categories')
     for txn in txns:
         category_id = get_category(wf, txn)
-        post_date = parse(txn['post'])
+        post_date = to_date(txn['post'])
         time_cut = get_time_cut(post_date, ta, ct)
         if not min_date or post_date < min_date: min_date = post_date
         if not max_date or post_date > max_date: max_date = post_date
@@ -85,6 +90,7 @@ def create_chart(wf, txns):
     return chart
          
 def get_chart_url(wf, txns):
+    import urllib.parse
     chart = create_chart(wf, txns)
     url = f"https://quickchart.io/chart?width=500&height=300&chart={urllib.parse.quote_plus(json.dumps(chart, separators=(',', ':')))}"
     log.debug(url)
@@ -93,11 +99,15 @@ def get_chart_url(wf, txns):
 def format_post_date(dt):
     format = '%b-%d'
     this_year = datetime.now().year
-    given_date = parse(dt)
+    given_date = to_date(dt)
     date_year = given_date.year
     format = f"{format}-%y" if(date_year != this_year) else f"{format}   "
     return given_date.strftime(format)
     
+def bank_icon(banks, institution_id):
+    # a bank just added by a running sync has no icon until the sync finishes
+    return banks[institution_id].get('icon') or 'icons/ui/account.png'
+
 def get_acct_subtitle(acct):
     result = ''
     if 'subtype' in acct:
@@ -111,13 +121,106 @@ def get_acct_subtitle(acct):
             result = f"{result}|   limit: ${acct['balances']['limit']:,.2f} "
     return result
        
-def get_txn_icon(wf, txn, accounts, banks, merchants, categories, icons):
-    icon = get_merchant_icon(wf, txn['merchant_id'], merchants, icons)
+def get_txn_icon(wf, txn, accounts, banks, merchants, categories, icons, misses):
+    # only icons already on disk - missing ones are fetched in the background
+    icon = known_icon(wf, 'merchant', txn['merchant_id'], merchants, icons, misses)
     if icon: return icon
     icon = get_category_icon(wf, txn['category_id'], categories, icons)
     if icon: return icon
-    icon = get_bank_icon(wf, accounts[txn['account_id']]['institution_id'], banks, icons)
-    return icon
+    icon = known_icon(wf, 'bank', accounts[txn['account_id']]['institution_id'], banks, icons, misses)
+    return icon if icon else 'icons/ui/merchant.png'
+
+def build_results(wf, db, parsed, prequery, page, page_size, items, accounts, banks, merchants, categories, icons):
+    """Alfred items for one page of transactions matching the parsed query"""
+    results = []
+    # one row past the page tells whether there is another page
+    txns = db.get_results(parsed, page_size + 1, (page - 1) * page_size)
+    more = txns is not None and len(txns) > page_size
+    txns = txns[:page_size] if txns else txns
+    if not txns:
+        if items and accounts:
+            results.append(dict(
+                    title="No matching transactions found...",
+                    subtitle="Please try another search term",
+                    valid=False,
+                    icon="icons/ui/empty.png"
+            ))
+    else:
+        if parsed.has('cht'):
+            results.append(dict(
+                title="Chart the transactions",
+                subtitle=f"Highlight and tap SHIFT key for {chart_types[chart_options['ct']]} chart aggregated by {time_aggregates[chart_options['ta']]} and {merchant_aggregates[chart_options['ma']]}",
+                valid=False,
+                quicklookurl=get_chart_url(wf,db.get_results(parsed)), # charts cover every match, not just this page
+                icon='icons/ui/chart.png'
+            ))
+        txn_list = txns
+        cat_id = parsed.get('cat')
+        txn_id = parsed.get('txn')
+        custom_categories = get_stored_data(wf, 'custom_categorization', {})
+        misses = []
+        for txn in txn_list:
+            merchant_id = txn['merchant_id']
+            acct = accounts[txn['account_id']]
+            post = format_post_date(txn['post'])
+            acct_name = acct['nick'] if 'nick' in acct else acct['name']
+
+            if not cat_id or not txn_id:
+                category_id = get_category(wf, txn, custom_categories)
+                category = ' > '.join(categories[category_id]['list'])
+                subtitle = f"{acct_name} | {category}     {txn['txntext']}"
+            else:
+                category = ' > '.join(categories[int(cat_id)]['list'])
+                subtitle = f"Change category to {category}"
+            merchant = txn['merchant'] if txn['merchant'] else ''
+            txntext = txn['txntext']
+            title = merchant if merchant else txntext
+            #log.debug(f"{merchant_id} | {txn['txntext']} | {merchant}")
+            title = title.ljust(50)
+            arg = f' --merchant_id {merchant_id}' if cat_id and merchant_id else ''
+            if not arg:
+                arg = f" --merchant {quote(merchant)}" if cat_id and (not merchant_id  and merchant) else ''
+            if not arg:
+                arg = f" --txntext {quote(txntext)}" if cat_id and (not merchant_id  and txntext) else ''
+            arg = arg + f' --category_id {cat_id}' if cat_id else ''
+            results.append(dict(
+                    title=f"{post}    {title}    ${txn['amount']:.2f}",
+                    subtitle=subtitle,
+                    autocomplete=f"txn:{txn['transaction_id']} ",
+                    arg=arg,
+                    valid=('--merchant' in arg or '--txntext' in arg) and '--category_id' in arg,
+                    icon=get_txn_icon(wf, txn, accounts, banks, merchants, categories, icons, misses)
+            ))
+        queue_icons(wf, misses)
+        if more:
+            summary = db.get_summary(parsed)
+            first = (page - 1) * page_size + 1
+            results.append(dict(
+                    title="More results...",
+                    subtitle=f"Showing {first}-{first + len(txns) - 1} of {summary['count']} totalling ${summary['total']:,.2f}",
+                    autocomplete=f"{prequery} pg:{page + 1} ",
+                    valid=False,
+                    icon="icons/ui/download.png"
+            ))
+    return results
+
+def results_key(wf, db, parsed, prequery):
+    """Everything a page of results depends on - any change in the data bumps the DB generation"""
+    state = tuple(stored_data_stat(wf, x) for x in [LOCAL_STORE, f'{get_environment(wf)}.custom_categorization'])
+    options = tuple(sorted(chart_options.items()))
+    return repr((get_environment(wf), parsed.key, parsed.has('cht'), prequery, options, get_page_size(wf), db.generation(), state, datetime.now().date()))
+
+def get_cached_results(wf, key):
+    cache = wf.cached_data(RESULTS_CACHE, None, max_age=0)
+    return cache[key] if cache and key in cache else None
+
+def cache_results(wf, key, results):
+    cache = wf.cached_data(RESULTS_CACHE, None, max_age=0) or {}
+    cache.pop(key, None)
+    cache[key] = results
+    # dicts keep insertion order, so the oldest entries are first
+    while len(cache) > RESULTS_CACHE_SIZE: del cache[next(iter(cache))]
+    wf.cache_data(RESULTS_CACHE, cache)
 
 def add_config_commands(args, config_commands):
     words = args.query.lower().split() if args.query else []
@@ -175,7 +278,7 @@ def add_all_accounts(wf, query, opts):
 
 def add_item_errors(wf, query):
     if 'link ' in query: return
-    items = get_secure_value(wf, 'items', {})
+    items = get_items(wf, False)
     for item in items:
         if 'error' in items[item] and items[item]['error']:
             wf.add_item(
@@ -202,16 +305,18 @@ def main(wf):
     args = parser.parse_args(wf.args)
 
     log.debug("args are "+str(args))
+    # options set by an earlier query must not leak into this one when run by the daemon
+    chart_options.update(chart_defaults)
 
     words = args.query.split() if args.query else []
-    accounts = get_secure_value(wf, 'accounts', {})
-    banks = get_stored_data(wf, 'banks')
-    merchants = get_stored_data(wf, 'merchants')
-    categories = get_stored_data(wf, 'categories')
+    accounts = get_local_value(wf, 'accounts', {})
+    banks = get_metadata(wf, 'banks')
+    merchants = get_metadata(wf, 'merchants')
+    categories = get_metadata(wf, 'categories')
     environ = get_environment(wf)
-    items = get_secure_value(wf, 'items', {})
-    icons = get_stored_data(wf, 'icons', ICONS_DEFAULT)
-    acct_filter = get_secure_value(wf, 'acct_filter', [])
+    items = get_items(wf, False)
+    icons = get_metadata(wf, 'icons')
+    acct_filter = get_local_value(wf, 'acct_filter', [])
     
     config_commands = {
         'link': {
@@ -464,7 +569,7 @@ def main(wf):
                 'title': lambda x: f"{x}",
                 'subtitle': lambda x,y: f"Filter transactions within {x.lower()}",
                 'icon': lambda x: f"icons/ui/{x.split()[1]}.png",
-                'suffix': '\:',
+                'suffix': ':',
                 'options': timeframes,
                 'id': lambda x: x.lower().replace(' ','-'),
                 'valid': False            
@@ -474,7 +579,7 @@ def main(wf):
                 'title': lambda x: f"{x['list'][-1]}",
                 'subtitle': lambda x,y: f"{' > '.join(x['list'])}",
                 'icon': lambda x: f"{x['icon']}",
-                'suffix': '\:',
+                'suffix': ':',
                 'options': categories,
                 'filter_func': lambda x: f"{', '.join(categories[x]['list'])}",
                 'id': lambda x: x if 0 != x else None,
@@ -485,8 +590,8 @@ def main(wf):
                 'special_items_func': add_all_accounts,
                 'title': lambda x: f"{x['nick'] if 'nick' in x else x['name']}",
                 'subtitle': lambda x,y: ('Remove' if x['account_id'] in acct_filter else 'Add')+' this account to filter' if 'filter' in y else ('Set account nickname to '+extract_nick(y) if 'nick' in y else (f"{banks[x['institution_id']]['name']} {get_acct_subtitle(x)}")),
-                'icon': lambda x: f"{banks[x['institution_id']]['icon']}",
-                'suffix': '\:',
+                'icon': lambda x: bank_icon(banks, x['institution_id']),
+                'suffix': ':',
                 'arg': lambda x, y: f"{'--filter ' if 'filter ' in y else ''}{'--nick '+quote(extract_nick(y)) if 'nick ' in y else ''} --acctid {x}",
                 'options': accounts,
                 'filter_func': lambda x: f"{banks[accounts[x]['institution_id']]['name']} {accounts[x]['name']} {accounts[x]['subtype']} {accounts[x]['nick'] if 'nick' in accounts[x] else ''} {x}",
@@ -497,7 +602,7 @@ def main(wf):
                 'special_items_func': add_new_link,
                 'title': lambda x: banks[x['institution_id']]['name'],
                 'subtitle': lambda x,y: f"{'*ERROR* ' if x['error'] else ''} Update link to {banks[x['institution_id']]['name']}",
-                'icon': lambda x: banks[x['institution_id']]['icon'] if not x['error'] else 'icons/ui/broken.png',
+                'icon': lambda x: bank_icon(banks, x['institution_id']) if not x['error'] else 'icons/ui/broken.png',
                 'suffix': ' ',
                 'arg': lambda x, y: f"--link {x}",
                 'options': items,
@@ -508,7 +613,7 @@ def main(wf):
                 'name': 'delete',
                 'title': lambda x: banks[x['institution_id']]['name'],
                 'subtitle': lambda x,y: f"{'*ERROR* ' if x['error'] else ''} Remove all accounts and link to {banks[x['institution_id']]['name']}",
-                'icon': lambda x: banks[x['institution_id']]['icon'] if 'error' not in x or not x['error'] else 'icons/ui/broken.png',
+                'icon': lambda x: bank_icon(banks, x['institution_id']) if 'error' not in x or not x['error'] else 'icons/ui/broken.png',
                 'suffix': ' ',
                 'arg': lambda x, y: f"--delete {x}",
                 'options': items,
@@ -520,7 +625,7 @@ def main(wf):
                 'special_items_func': add_refresh_all,
                 'title': lambda x: banks[x['institution_id']]['name'],
                 'subtitle': lambda x,y: f"{'*ERROR* ' if x['error'] else ''} Force refresh of transactions from {banks[x['institution_id']]['name']}",
-                'icon': lambda x: banks[x['institution_id']]['icon'] if not x['error'] else 'icons/ui/broken.png',
+                'icon': lambda x: bank_icon(banks, x['institution_id']) if not x['error'] else 'icons/ui/broken.png',
                 'suffix': ' ',
                 'arg': lambda x, y: f"--refresh {x}",
                 'options': items,
@@ -532,7 +637,7 @@ def main(wf):
                 'title': lambda x: f"{x}",
                 'subtitle': lambda x,y: f"Chart type {x.lower()}",
                 'options': chart_types,
-                'suffix': '\:',
+                'suffix': ':',
                 'set': {'holder': chart_options, 'field': 'ct'},
                 'valid': False                        
         },
@@ -541,7 +646,7 @@ def main(wf):
                 'title': lambda x: f"Aggregate transactions over {x}s",
                 'subtitle': lambda x,y: f"Totals transactions with a {x.lower()} for charting",
                 'options': time_aggregates,
-                'suffix': '\:',
+                'suffix': ':',
                 'set': {'holder': chart_options, 'field': 'ta'},
                 'valid': False                                    
         },
@@ -550,7 +655,7 @@ def main(wf):
                 'title': lambda x: f"Aggregate transactions by {x}",
                 'subtitle': lambda x,y: f"Totals transactions by {x.lower()} for charting",
                 'options': merchant_aggregates,
-                'suffix': '\:',
+                'suffix': ':',
                 'set': {'holder': chart_options, 'field': 'ma'},
                 'valid': False                                                
         }
@@ -564,7 +669,7 @@ def main(wf):
     ####################################################################
 
 
-    client_id = get_secure_value(wf, 'client_id', None, ALL_USER, ALL_ENV)
+    client_id = has_credential(wf, 'client_id', ALL_USER, ALL_ENV)
     if not client_id:
         wf.add_item('No Client ID key set...',
                     'Please use pd clientid to set your Plaid Client ID.',
@@ -574,7 +679,7 @@ def main(wf):
         wf.send_feedback()
         return 0
 
-    secret = get_secure_value(wf, 'secret', None, ALL_USER)
+    secret = has_credential(wf, 'secret', ALL_USER)
     if not secret:
         wf.add_item(f'No Client Secret key set for {environ}...',
                     'Please use pd secret to set your Plaid Client Secret.',
@@ -611,7 +716,7 @@ def main(wf):
         
     add_item_errors(wf, query)
     
-    items = get_secure_value(wf, 'items', None)
+    items = get_items(wf, False)
     if not items:
         wf.add_item('No Linked Financial Institutions Found...',
                     'Please use pd link to link your bank accounts',
@@ -630,16 +735,18 @@ def main(wf):
 
     # If script was passed a query, use it to filter posts
     if query:
+        # parsed once, the same parse answers the option completions below and the DB search
+        parsed = parse_query(query)
         for opt in config_options:
             suffix = config_options[opt]['suffix']
             opts = config_options[opt]['options']
             is_array = isinstance(opts, list)
             if not is_array: opts = list(opts.keys())
-            found = re.findall(fr'{opt}{suffix}([^\s]+)', query)
-            term = found[0] if found else ''
-            if re.findall(fr'{opt}{suffix}[^\s]*\s*$', query):
-                matches = wf.filter(term, opts, config_options[opt]['filter_func'] if 'filter_func' in config_options[opt] else (lambda x: x if is_array else config_options[opt]['options'][x]))
-                prequery = re.sub(fr'{opt}{suffix}[^\s]*\s*$','',query)
+            term = (parsed.value(opt) if ':' == suffix else parsed.word_after(opt)) or ''
+            tail = parsed.tail(opt, suffix)
+            if tail:
+                matches = wf.filter(tail[0], opts, config_options[opt]['filter_func'] if 'filter_func' in config_options[opt] else (lambda x: x if is_array else config_options[opt]['options'][x]))
+                prequery = tail[1]
                 if 'special_items_func' in config_options[opt]:
                     config_options[opt]['special_items_func'](wf, prequery, opts)
                 for item in matches:
@@ -650,7 +757,6 @@ def main(wf):
                     valid = config_options[opt]['valid']
                     if type(valid) is not bool:
                         valid = valid(prequery, item)
-                    suffix = suffix.replace("\\",'')
                     wf.add_item(
                             title=config_options[opt]['title'](name),
                             subtitle=config_options[opt]['subtitle'](name, prequery),
@@ -659,70 +765,29 @@ def main(wf):
                             valid=valid,
                             icon=icon
                     )
-            if found:
+            if term:
                 #log.debug(f'found {term} with {opts}')
-                if term and (term in opts):
+                if term in opts:
                     if 'set' in config_options[opt]:
                         config_options[opt]['set']['holder'][config_options[opt]['set']['field']] = term
     
     
-        db = TxnDB(get_db_file(wf), wf.logger)
-        acct_filter = get_secure_value(wf, 'acct_filter', [])
-        if acct_filter: query = f"{query} act:{','.join(acct_filter)}"
-        txns = db.get_results(query)
-        if not txns:
-            if items and accounts:
-                wf.add_item(
-                        title="No matching transactions found...",
-                        subtitle="Please try another search term",
-                        valid=False,
-                        icon="icons/ui/empty.png"
-                )
-        else:
-            if 'cht:' in query:
-                wf.add_item(
-                    title="Chart the transactions",
-                    subtitle=f"Highlight and tap SHIFT key for {chart_types[chart_options['ct']]} chart aggregated by {time_aggregates[chart_options['ta']]} and {merchant_aggregates[chart_options['ma']]}",
-                    valid=False,
-                    quicklookurl=get_chart_url(wf,txns),
-                    icon='icons/ui/chart.png'
-                )
-            txn_list = txns #[:30] if len(txns) > 30 else txns                
-            query, cat_id = extract_filter(query, 'cat', 'text')
-            query, txn_id = extract_filter(query, 'txn', 'text')
-            custom_categories = get_stored_data(wf, 'custom_categorization', {})
-            for txn in txn_list:
-                merchant_id = txn['merchant_id']
-                acct = accounts[txn['account_id']]
-                post = format_post_date(txn['post'])
-                acct_name = acct['nick'] if 'nick' in acct else acct['name']
-
-                if not cat_id or not txn_id:
-                    category_id = get_category(wf, txn, custom_categories)
-                    category = ' > '.join(categories[category_id]['list'])
-                    subtitle = f"{acct_name} | {category}     {txn['txntext']}"
-                else:
-                    category = ' > '.join(categories[int(cat_id)]['list'])
-                    subtitle = f"Change category to {category}"
-                merchant = txn['merchant'] if txn['merchant'] else ''
-                txntext = txn['txntext']
-                title = merchant if merchant else txntext
-                #log.debug(f"{merchant_id} | {txn['txntext']} | {merchant}")
-                title = title.ljust(50)
-                arg = f' --merchant_id {merchant_id}' if cat_id and merchant_id else ''
-                if not arg:
-                    arg = f" --merchant {quote(merchant)}" if cat_id and (not merchant_id  and merchant) else ''
-                if not arg:
-                    arg = f" --txntext {quote(txntext)}" if cat_id and (not merchant_id  and txntext) else ''
-                arg = arg + f' --category_id {cat_id}' if cat_id else ''
-                wf.add_item(
-                        title=f"{post}    {title}    ${txn['amount']:.2f}",
-                        subtitle=subtitle,
-                        autocomplete=f"txn:{txn['transaction_id']} ",
-                        arg=arg,
-                        valid=('--merchant' in arg or '--txntext' in arg) and '--category_id' in arg,
-                        icon=get_txn_icon(wf, txn, accounts, banks, merchants, categories, icons)
-                )
+        page = parsed.get('pg', 1)
+        page = page if page > 0 else 1
+        page_size = get_page_size(wf)
+        prequery = parsed.without('pg')
+        acct_filter = get_local_value(wf, 'acct_filter', [])
+        if acct_filter: parsed = parse_query(f"{query} act:{','.join(acct_filter)} ")
+        # left open - the daemon answers the next query from the same connection
+        db = get_db(wf)
+        # repeats of a query are answered from the cache until the data behind them changes
+        key = results_key(wf, db, parsed, prequery)
+        results = get_cached_results(wf, key)
+        if results is None:
+            results = build_results(wf, db, parsed, prequery, page, page_size, items, accounts, banks, merchants, categories, icons)
+            cache_results(wf, key, results)
+        for result in results:
+            wf.add_item(**result)
 
         # Send the results to Alfred as XML
         wf.send_feedback()
@@ -1,51 +1,131 @@
-from workflow import web
 import json
-from common import get_category_icon, qnotify, get_merchant_icon, get_environment, get_bank_icon, get_stored_data, ICONS_DEFAULT, set_stored_data
-from time import time
+import random
+import threading
+import http.client
+from transport import Transport, TokenBucket, CircuitBreaker
+from common import qnotify, get_environment
+from time import sleep
 
 ERROR_MESSAGES = {
     'default': "Plaid API Error",
     'ITEM_LOGIN_REQUIRED': "Login needs updating"
 }
 
+MAX_RETRIES = 4
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30
+RETRY_ERROR_TYPES = ['RATE_LIMIT_EXCEEDED', 'API_ERROR']
+RETRY_ERROR_CODES = ['PRODUCT_NOT_READY', 'INTERNAL_SERVER_ERROR', 'PLANNED_MAINTENANCE']
+# (calls per second, burst) for each endpoint, shared by all items
+RATE_LIMITS = {
+    'default': (5, 10),
+    '/transactions/sync': (10, 20),
+    '/accounts/get': (5, 10),
+    '/item/get': (5, 10)
+}
+# endpoints that only read, so one whose request may already have reached Plaid is safe to send again
+READ_PATHS = ['/transactions/sync', '/accounts/get', '/item/get', '/categories/get', '/institutions/get_by_id']
+BREAKER_THRESHOLD = 3
+BREAKER_COOLDOWN = 60
+
+class PlaidError(Exception):
+    def __init__(self, code, message=None):
+        super().__init__(message if message else code)
+        self.code = code
+
 class Plaid:
-    def __init__(self, client_id, secret, user_id, wf):
+    def __init__(self, client_id, secret, user_id, wf, base_url=None):
         self.client_id = client_id
         self.secret = secret
         self.user_id = user_id
         self.environment = str(get_environment(wf))
+        self.base_url = base_url if base_url else f'https://{self.environment}.plaid.com'
         self.logger = wf.logger
         self.wf = wf
+        self.transport = Transport(logger=self.logger)
+        self.buckets = {}
+        self.breakers = {}
+        self.lock = threading.Lock()
         
     def debug(self, text):
         if(self.logger): self.logger.debug(text)
         
-    def api(self, path, data={}, no_auth=False):
-        url = f'https://{self.environment}.plaid.com{path}'
+    def close(self):
+        self.transport.close()
+
+    def bucket(self, path):
+        with self.lock:
+            if path not in self.buckets:
+                self.buckets[path] = TokenBucket(*(RATE_LIMITS[path] if path in RATE_LIMITS else RATE_LIMITS['default']))
+            return self.buckets[path]
+
+    def breaker(self, access_token):
+        if not access_token: return None
+        with self.lock:
+            if access_token not in self.breakers:
+                self.breakers[access_token] = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_COOLDOWN)
+            return self.breakers[access_token]
+
+    def is_retryable(self, status_code, result):
+        if 429 == status_code or status_code >= 500: return True
+        if not result or 'error_code' not in result: return False
+        return result.get('error_type') in RETRY_ERROR_TYPES or result['error_code'] in RETRY_ERROR_CODES
+
+    def retry_delay(self, attempt):
+        # exponential backoff with full jitter so parallel syncs don't retry in lockstep
+        return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+    def api(self, path, data={}, no_auth=False, timeout=None):
+        url = f'{self.base_url}{path}'
         headers = {'Accept':"application/json", 'Content-Type': "application/json"}
         params = {'client_id': self.client_id, 'secret': self.secret} if not no_auth else {}
         params = {**params, **data}
+        breaker = self.breaker(data.get('access_token'))
+        if breaker and not breaker.allow():
+            raise PlaidError('CIRCUIT_OPEN', f'{path} skipped, item has failed {breaker.failures} times in a row')
+        bucket = self.bucket(path)
         r = None
-        self.debug("plaid_api: url:"+url+", headers: "+str(headers)+", params: "+str(params))
-        r = web.post(url, headers=headers, data=json.dumps(params))
-        self.debug("plaid_api: url:"+url+", headers: "+str(headers)+", params: "+str(params)+", return code: "+str(r.status_code))
+        for attempt in range(MAX_RETRIES + 1):
+            bucket.acquire()
+            result = None
+            try:
+                r = self.transport.post(url, headers=headers, data=json.dumps(params), timeout=timeout)
+            except (OSError, http.client.HTTPException) as e:
+                self.debug(f"plaid_api: url:{url}, attempt {attempt + 1} failed: {e}")
+                # a write like /item/public_token/exchange may have gone through, and its token only works once
+                if attempt == MAX_RETRIES or path not in READ_PATHS:
+                    if breaker: breaker.failure()
+                    raise
+                sleep(self.retry_delay(attempt))
+                continue
+            self.debug("plaid_api: url:"+url+", return code: "+str(r.status_code))
+            try:
+                result = r.json()
+            except ValueError:
+                result = None
+            if not self.is_retryable(r.status_code, result) or attempt == MAX_RETRIES: break
+            if 429 == r.status_code or (result and 'RATE_LIMIT_EXCEEDED' == result.get('error_type')):
+                bucket.drain()
+            delay = self.retry_delay(attempt)
+            self.debug(f"plaid_api: url:{url}, retrying in {delay:0.2f}s after {result.get('error_code') if result else r.status_code}")
+            sleep(delay)
+        if breaker:
+            # only transient failures that outlasted the retries count against the item
+            if self.is_retryable(r.status_code, result):
+                breaker.failure()
+            else:
+                breaker.success()
         # throw an error if request failed
         # Workflow will catch this and show it to the user
-        result = None
-        if(r.status_code == 200):
-            # Parse the JSON returned by pinboard and extract the posts
-            result = r.json()
-        else:
-            result = r.json()
+        if(r.status_code != 200):
             if result and 400 == r.status_code and 'error_code' in result:
                 error = ERROR_MESSAGES[result['error_code']] if result['error_code'] in ERROR_MESSAGES else ERROR_MESSAGES['default']
                 qnotify('Plaid', error)
-        self.debug(str(result))
+            self.debug(str(result))
         return result   
     
     def get_categories(self, wf):
         categories = {}
-        icons = get_stored_data(wf, 'icons', ICONS_DEFAULT)
         result = self.api(path="/categories/get", data={}, no_auth=True)
         if 'categories' in result:
             for category in result['categories']:
@@ -55,7 +135,6 @@ class Plaid:
                     'id': id,
                     'list': category['hierarchy']
                 }
-                categories[id]['icon'] = get_category_icon(wf, id, categories, icons)
         return categories
     
     def get_link_token(self, item, proto='https'):
@@ -114,24 +193,18 @@ class Plaid:
         result = self.api(path="/item/remove", data=data)
         return result
     
-    def get_accounts(self, item, banks):
-        icons = get_stored_data(self.wf, 'icons', ICONS_DEFAULT)
+    def get_accounts(self, item):
+        """Return the item's accounts tagged with their institution and item ids
+
+        Does not touch stored metadata so it can run in a sync worker thread.
+        """
         data = {"access_token": item.get('access_token')}
         result = self.api(path="/accounts/get", data=data)
         if 'error_code' in result:
             return result['error_code']
         
-        bank = None
-        if 'item' in result and 'institution_id' in result['item']:
-            if result['item']['institution_id'] not in banks:
-                bank = self.get_institution_by_id(result['item']['institution_id'])
-                banks[result['item']['institution_id']] = bank
-            else:
-                bank = banks[result['item']['institution_id']]
-            if bank:
-                bank['icon'] = get_bank_icon(self.wf, result['item']['institution_id'], banks, icons)
         if 'accounts' in result:
-            if bank:
+            if 'item' in result and result['item'].get('institution_id'):
                 for i in range(len(result['accounts'])):
                     result['accounts'][i]['institution_id'] = result['item']['institution_id']
                     result['accounts'][i]['item_id'] = result['item']['item_id']
@@ -139,7 +212,9 @@ class Plaid:
         else:
             return None
         
-    def update_metadata(self, txns, merchants, icons):
+    def update_metadata(self, txns, merchants):
+        """Record merchants not seen before and return their ids - their icons are left to the caller"""
+        added = []
         for txn in txns:
             if 'merchant_entity_id' in txn and txn['merchant_entity_id']:
                 merchant_id = txn['merchant_entity_id']
@@ -152,26 +227,25 @@ class Plaid:
                         'url': txn['website'] if 'website' in txn else None,
                         'categories': None
                     }
-                    start = time()
-                    merchants[merchant_id]['icon'] = get_merchant_icon(self.wf, merchant_id, merchants, icons)
-                    self.logger.debug(f"{(time() - start):0.3f} to get merchant icon")
-        return merchants
+                    added.append(merchant_id)
+        return added
+
+    def get_transactions(self, item, cursor=None):
+        """Yield the /transactions/sync pages after `cursor` one at a time
 
-    def get_transactions(self, item, merchants):
+        Each page holds the `added`, `modified` and `removed` deltas and the
+        `next_cursor` to resume from once the page has been saved. Merchant
+        metadata is left to the caller so this can run in a worker thread.
+        """
         done = False
-        txns = []
-        icons = get_stored_data(self.wf, 'icons', ICONS_DEFAULT)
         while(not done):
             data = {"access_token": item.get('access_token')}
-            if 'txn_cursor' in item: data['cursor'] = item.get('txn_cursor')
+            if cursor: data['cursor'] = cursor
             result = self.api(path="/transactions/sync", data=data)
-            if 'added' in result:
-                txns.extend(result['added'])
-                self.update_metadata(result['added'], merchants, icons)
-            if 'next_cursor' in result:
-                item['txn_cursor'] = result['next_cursor']
+            if not result or 'error_code' in result:
+                raise PlaidError(result['error_code'] if result else 'NO_RESPONSE', result.get('error_message') if result else None)
+            page = {x: result[x] if x in result else [] for x in ['added', 'modified', 'removed']}
+            cursor = result['next_cursor'] if 'next_cursor' in result else cursor
+            page['next_cursor'] = cursor
+            yield page
             done = not result['has_more']
-        set_stored_data(self.wf, 'icons', icons)
-        #self.debug(txns)
-        return txns
-    
\ No newline at end of file
@@ -0,0 +1,89 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from common import icon_due, icon_key, icon_source, lookup_icon, record_icon, save_icon
+
+ICON_CONCURRENCY = 8
+ICON_HOST_CONCURRENCY = 2
+
+class IconPrefetch:
+    """Downloads merchant and bank icons on a bounded pool while a sync runs
+
+    Only the downloads happen in worker threads. Stored metadata is read and
+    updated by the thread that owns it, when `finish` is called. The same URL
+    is only ever downloaded once, and no more than `per_host` downloads hit
+    one host at a time.
+    """
+    def __init__(self, wf, icons, workers=ICON_CONCURRENCY, per_host=ICON_HOST_CONCURRENCY):
+        self.wf = wf
+        self.icons = icons
+        self.per_host = per_host
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.hosts = {}
+        self.inflight = {}
+        self.pending = []
+
+    def debug(self, text):
+        self.wf.logger.debug(text)
+
+    def host_limit(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = threading.Semaphore(self.per_host)
+            return self.hosts[host]
+
+    def download(self, path, url):
+        if not url.startswith('http'): return save_icon(self.wf, path, url)
+        with self.host_limit(url):
+            return save_icon(self.wf, path, url)
+
+    def fetch(self, type, key, url=None):
+        """Indexed icon path for `key`, or a future for its download"""
+        record = lookup_icon(self.wf, type, key, self.icons)
+        if not icon_due(record): return record['path']
+        path, url = icon_source(self.wf, type, key, url)
+        if not url: return record['path'] if record else None
+        if url not in self.inflight:
+            self.inflight[url] = self.pool.submit(self.download, path, url)
+        return self.inflight[url], url
+
+    def add(self, type, holder, id, name, url=None):
+        if not name: return
+        key = icon_key(name)
+        icon = self.fetch(type, key, url)
+        if isinstance(icon, tuple):
+            self.pending.append((type, holder, id, key, *icon))
+        else:
+            self.resolve(holder, id, icon)
+
+    def resolve(self, holder, id, icon):
+        entry = holder[id]
+        entry['icon'] = icon
+        holder[id] = entry
+
+    def merchant(self, merchants, merchant_id):
+        merchant = merchants[merchant_id]
+        if merchant.get('icon'): return
+        self.add('merchant', merchants, merchant_id, merchant['name'], merchant['logo'])
+
+    def bank(self, banks, institution_id):
+        bank = banks[institution_id]
+        if bank.get('icon'): return
+        self.add('bank', banks, institution_id, bank['name'], bank['logo'])
+
+    def finish(self):
+        """Wait for the downloads and record the icons - call from the thread that owns the metadata"""
+        self.pool.shutdown(wait=True)
+        for type, holder, id, key, future, url in self.pending:
+            try:
+                icon = future.result()
+            except Exception as e:
+                self.debug(f'icon for {key} failed: {e}')
+                icon = ''
+            # failures are recorded too so they are retried with backoff instead of on every run
+            self.resolve(holder, id, record_icon(self.wf, type, key, self.icons, icon, url))
+        self.debug(f'prefetched {len(self.inflight)} icons for {len(self.pending)} entries')
+        self.pending = []
+        self.inflight = {}
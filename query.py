@@ -0,0 +1,106 @@
+import re
+from functools import lru_cache
+
+# type of the value of each key:value filter
+FILTERS = {
+    'dtf': 'date',
+    'dtt': 'date',
+    'amtf': 'number',
+    'amtt': 'number',
+    'srt': 'sort',
+    'ord': 'order',
+    'act': 'list',
+    'dt': 'text',
+    'cat': 'text',
+    'txn': 'text',
+    'pg': 'number'
+}
+# the only values srt: and ord: can put into the SQL
+SORTS = ['post', 'amount', 'merchant', 'txntext', 'rank']
+ORDERS = ['ASC', 'DESC']
+TOKEN = re.compile(r'(\w+):(\S*)$')
+
+class Query:
+    """A search query split into search terms and key:value filters
+
+    A filter only applies once it is followed by a space, so one that is
+    still being typed is left out of `filters` - but it is still in `tokens`
+    for completing it in the UI. Values that do not parse are dropped.
+    """
+    def __init__(self, text):
+        self.text = text
+        self.words = text.split()
+        self.open = bool(text) and not text[-1].isspace()
+        self.tokens = []  # (key, raw value, complete) in query order
+        self.terms = []
+        self.filters = {}
+        for i, word in enumerate(self.words):
+            match = TOKEN.match(word)
+            if not match:
+                # a stray ':' would be read as a column filter by FTS
+                if ':' not in word: self.terms.append(word)
+                continue
+            key, raw = match.groups()
+            complete = i < len(self.words) - 1 or not self.open
+            self.tokens.append((key, raw, complete))
+            if complete and key in FILTERS and key not in self.filters:
+                value = convert(FILTERS[key], raw)
+                if value is not None: self.filters[key] = value
+        self.terms = tuple(self.terms)
+        self.match = ' '.join(fts_term(x) for x in self.terms)
+        self.key = (self.terms, tuple(sorted((x, str(y)) for x, y in self.filters.items())))
+
+    def get(self, key, default=None):
+        return self.filters[key] if key in self.filters else default
+
+    def value(self, key):
+        """Raw value of the first `key:` token, whether or not it is complete"""
+        return next((x[1] for x in self.tokens if x[0] == key), None)
+
+    def has(self, key):
+        return any(x[0] == key for x in self.tokens)
+
+    def tail(self, opt, suffix=':'):
+        """(term being typed, query before it) if the query ends with `opt` and its suffix, else None"""
+        words = self.words
+        if ':' == suffix:
+            match = TOKEN.match(words[-1]) if words else None
+            if not match or match.group(1) != opt: return None
+            return match.group(2), self.before(len(words) - 1)
+        if words and words[-1] == opt and not self.open:
+            return '', self.before(len(words) - 1)
+        if len(words) > 1 and words[-2] == opt:
+            return words[-1], self.before(len(words) - 2)
+        return None
+
+    def word_after(self, opt):
+        """Word following the command word `opt`"""
+        return next((self.words[i + 1] for i in range(len(self.words) - 1) if self.words[i] == opt), None)
+
+    def before(self, index):
+        return ''.join(f'{x} ' for x in self.words[:index])
+
+    def without(self, *keys):
+        """Query text with the given filters taken out"""
+        return ' '.join(x for x in self.words if not (TOKEN.match(x) and TOKEN.match(x).group(1) in keys))
+
+def fts_term(word):
+    """Prefix search for a word as an FTS5 string, so ' & - and the like are not read as query syntax"""
+    return '"' + word.replace('"', '""') + '"*'
+
+def convert(type, raw):
+    try:
+        if 'date' == type:
+            from dateutil.parser import parse
+            return parse(raw)
+        if 'number' == type: return int(raw)
+        if 'list' == type: return tuple(x for x in raw.split(',') if x) or None
+        if 'sort' == type: return raw.lower() if raw.lower() in SORTS else None
+        if 'order' == type: return raw.upper() if raw.upper() in ORDERS else None
+    except (ValueError, OverflowError):
+        return None
+    return raw if raw else None
+
+@lru_cache(maxsize=128)
+def parse_query(text):
+    return Query(text if text else '')
@@ -0,0 +1,102 @@
+import json
+import os
+import sys
+import copy
+from contextlib import contextmanager
+from workflow import PasswordNotFound
+
+SECURE_STORE = 'plaid_secure'
+SECURE_FILE = 'secure.json'
+
+class KeychainBackend:
+    """The whole store as one JSON blob in the macOS keychain"""
+    def __init__(self, wf, name=SECURE_STORE):
+        self.wf = wf
+        self.name = name
+
+    def load(self):
+        try:
+            data = self.wf.get_password(self.name)
+        except PasswordNotFound:  # Access Token has not yet been set
+            data = '{}'
+        return json.loads(data)
+
+    def save(self, data):
+        self.wf.save_password(self.name, json.dumps(data))
+
+class FileBackend:
+    """The whole store as a JSON file readable only by the user - for platforms without a keychain"""
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if not os.path.exists(self.path): return {}
+        with open(self.path, 'r') as file:
+            return json.load(file)
+
+    def save(self, data):
+        temp = f'{self.path}.tmp'
+        with open(os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as file:
+            json.dump(data, file)
+        os.replace(temp, self.path)
+
+class SecureStore:
+    """In-memory copy of the secure store that writes back to its backend
+
+    Outside a session every change is written immediately. Inside a session
+    changes are only written once, when the outermost session ends, and are
+    thrown away if it ends with an exception, back to the last `commit`.
+    Nested sessions join the outer one.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.data = None
+        self.depth = 0
+        self.dirty = False
+        self.snapshot = None
+
+    def get(self):
+        if self.data is None: self.data = self.backend.load()
+        return self.data
+
+    def reset(self):
+        self.data = {}
+        self.changed()
+
+    def changed(self):
+        if self.depth:
+            self.dirty = True
+        else:
+            self.flush()
+
+    def flush(self):
+        self.backend.save(self.get())
+        self.dirty = False
+
+    def commit(self):
+        """Write the changes a session has made so far, a later rollback keeps them"""
+        if self.dirty: self.flush()
+        if self.depth: self.snapshot = copy.deepcopy(self.get())
+
+    @contextmanager
+    def session(self):
+        if not self.depth:
+            self.snapshot = copy.deepcopy(self.get())
+            self.dirty = False
+        self.depth += 1
+        try:
+            yield self
+        except BaseException:
+            self.depth -= 1
+            if not self.depth:
+                self.data = self.snapshot
+                self.dirty = False
+            raise
+        self.depth -= 1
+        if not self.depth and self.dirty:
+            self.flush()
+
+def get_backend(wf):
+    """PLAID_SECURE_BACKEND picks `keychain` or `file`, the keychain is the default on macOS"""
+    backend = os.environ.get('PLAID_SECURE_BACKEND', 'keychain' if 'darwin' == sys.platform else 'file')
+    return FileBackend(wf.datafile(SECURE_FILE)) if 'file' == backend else KeychainBackend(wf)
@@ -0,0 +1,149 @@
+import os
+import sys
+import json
+import gzip
+import base64
+import time
+import atexit
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the workflow finds its data and cache dirs in the environment Alfred runs it with
+TEMP = tempfile.mkdtemp(prefix='alfred-plaid-tests-')
+atexit.register(shutil.rmtree, TEMP, True)
+os.environ.setdefault('alfred_workflow_data', os.path.join(TEMP, 'data'))
+os.environ.setdefault('alfred_workflow_cache', os.path.join(TEMP, 'cache'))
+os.environ.setdefault('alfred_workflow_bundleid', 'com.schwark.alfred-plaid.tests')
+os.environ.setdefault('alfred_version', '5.0')
+os.environ.setdefault('PLAID_SECURE_BACKEND', 'file')
+# modules are imported and create.sql is read from the workflow dir, as Alfred runs them
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+class FakePlaid:
+    """Local stand-in for the Plaid API
+
+    `replies[path]` is a list of replies handed out in order, the last one
+    repeating, or a function of the request body that returns one. A reply
+    is (status, body) or (status, body, delay in seconds). Paths without
+    replies answer 200 with an empty object.
+    """
+    def __init__(self):
+        self.replies = {}
+        self.calls = []
+        self.clients = set()
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])) or b'{}')
+                with fake.lock:
+                    fake.calls.append((self.path, body))
+                    fake.clients.add(self.client_address)
+                    replies = fake.replies.get(self.path, [])
+                if callable(replies):
+                    reply = replies(body)
+                else:
+                    with fake.lock:
+                        reply = replies.pop(0) if len(replies) > 1 else (replies[0] if replies else (200, {}))
+                status, result, delay = (reply + (0,))[:3]
+                if delay: time.sleep(delay)
+                content = json.dumps(result).encode('utf-8')
+                zipped = 'gzip' in self.headers.get('Accept-Encoding', '')
+                if zipped: content = gzip.compress(content)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                if zipped: self.send_header('Content-Encoding', 'gzip')
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def paths(self):
+        return [x[0] for x in self.calls]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+@pytest.fixture
+def wf():
+    from workflow import Workflow
+    return Workflow()
+
+@pytest.fixture
+def fake_plaid():
+    server = FakePlaid()
+    yield server
+    server.close()
+
+def txn(i, merchant='Starbucks', post='2024-01-01', account='acct1', category=13005000, amount=None):
+    """transactions row as TxnDB inserts it"""
+    return (f'txn{i}', account, 'USD', post, None, 'online', amount if amount is not None else i, 'purchase', merchant, f'm_{merchant}', 'Food and Drink,Restaurants', category, f'{merchant} #{i}')
+
+# saved as the merchant's icon without a download
+LOGO = base64.urlsafe_b64encode(b'\x89PNG\r\n\x1a\nlogo').decode()
+
+def plaid_txn(id, merchant='Starbucks', account='acct1', amount=1.0):
+    """transaction as /transactions/sync returns it"""
+    return {
+        'transaction_id': id, 'account_id': account, 'date': '2024-02-01', 'authorized_date': None,
+        'amount': amount, 'category_id': '13005000', 'iso_currency_code': 'USD', 'payment_channel': 'online',
+        'merchant_name': merchant, 'merchant_entity_id': f'm_{merchant}', 'name': f'{merchant} {id}', 'logo_url': LOGO
+    }
+
+@pytest.fixture
+def txn_db(tmp_path):
+    """Returns a function that makes a transactions DB holding the given rows"""
+    from db import TxnDB, INSERT_TXN
+    opened = []
+
+    def make(rows, name='txns.db'):
+        db = TxnDB(str(tmp_path / name))
+        con = db.connect()
+        with con:
+            con.executemany(INSERT_TXN, rows)
+        opened.append(db)
+        return db
+    yield make
+    for db in opened:
+        db.close()
+
+@pytest.fixture
+def linked(wf):
+    """A workflow with one linked account and a few transactions"""
+    from common import ALL_ENV, ALL_USER, DATABASES, get_db, get_db_file, get_metadata, save_metadata, set_credential, set_current_user, set_items, set_local_value
+    from db import INSERT_TXN, BUMP_GENERATION
+    set_credential(wf, 'client_id', 'client', ALL_USER, ALL_ENV)
+    set_credential(wf, 'secret', 'secret', ALL_USER)
+    set_current_user(wf, 'user')
+    set_items(wf, {'item1': {'item_id': 'item1', 'institution_id': 'ins1', 'error': None, 'access_token': 'tok1'}})
+    set_local_value(wf, 'accounts', {'acct1': {'account_id': 'acct1', 'name': 'Checking', 'subtype': 'checking', 'institution_id': 'ins1'}})
+    banks = get_metadata(wf, 'banks')
+    banks['ins1'] = {'name': 'Bank', 'logo': None, 'icon': None}
+    categories = get_metadata(wf, 'categories')
+    categories[13005000] = {'id': 13005000, 'list': ['Food and Drink', 'Restaurants'], 'icon': None}
+    save_metadata(wf, 'banks')
+    save_metadata(wf, 'categories')
+    con = get_db(wf).connect()
+    with con:
+        con.execute("DELETE FROM transactions")
+        con.execute("DELETE FROM sync_cursors")
+        con.executemany(INSERT_TXN, [txn(i) for i in range(3)])
+        con.execute(BUMP_GENERATION)
+    DATABASES.pop(get_db_file(wf)).close()
+    return wf
@@ -0,0 +1,109 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import pytest
+import common
+import daemon
+from common import get_db_file
+from conftest import txn
+from db import INSERT_TXN, BUMP_GENERATION
+
+def converse(monkeypatch, client):
+    """Serve from this thread, as the daemon does in its own process, while `client` talks to it from another"""
+    monkeypatch.setattr(daemon, 'IDLE_TIMEOUT', 1)
+    # a failed forward would otherwise start a real daemon process
+    monkeypatch.setattr(daemon, 'start', lambda: None)
+    path = daemon.socket_path()
+    errors = []
+
+    def run():
+        try:
+            for _ in range(250):
+                if os.path.exists(path): break
+                time.sleep(0.02)
+            client()
+        except BaseException as e:
+            errors.append(e)
+    thread = threading.Thread(target=run)
+    thread.start()
+    # returns once the daemon has been idle for IDLE_TIMEOUT
+    daemon.Daemon(path).serve()
+    thread.join()
+    assert not os.path.exists(path)
+    if errors: raise errors[0]
+
+def ask(capsys, query):
+    capsys.readouterr()
+    assert daemon.forward([query])
+    return [x['title'] for x in json.loads(capsys.readouterr().out)['items'] if 'Starbucks' in x['title']]
+
+def test_socket_path():
+    path = daemon.socket_path()
+    assert path.endswith('.sock') and str(os.getuid()) in os.path.basename(path)
+    assert path == daemon.socket_path()
+
+def test_no_daemon(linked, monkeypatch):
+    started = []
+    monkeypatch.setattr(daemon, 'start', lambda: started.append(True))
+    assert not daemon.forward(['starbucks '])
+    assert [True] == started
+
+def test_magic_arguments_not_forwarded(linked, monkeypatch):
+    converse(monkeypatch, lambda: not daemon.forward(['workflow:update']) or pytest.fail('forwarded'))
+
+def test_answers_from_warm_connection(linked, monkeypatch, capsys):
+    def client():
+        # the first query indexes icons, the daemon's own write costs it one reload
+        ask(capsys, 'starbucks ')
+        assert 3 == len(ask(capsys, 'starbucks '))
+        db = common.DATABASES[get_db_file(linked)]
+        con = db.con
+        assert 3 == len(ask(capsys, 'starbucks srt:amount '))
+        # the same connection answered both queries and is still open
+        assert con is not None
+        assert db is common.DATABASES[get_db_file(linked)] and con is db.con
+    converse(monkeypatch, client)
+
+def test_reloads_after_another_process_writes(linked, monkeypatch, capsys):
+    def client():
+        assert 3 == len(ask(capsys, 'starbucks '))
+        old = common.DATABASES[get_db_file(linked)]
+        con = sqlite3.connect(get_db_file(linked))
+        with con:
+            con.execute(INSERT_TXN, txn(9))
+            con.execute(BUMP_GENERATION)
+        con.close()
+        assert 4 == len(ask(capsys, 'starbucks '))
+        # the stale database was closed, not just dropped
+        assert old.con is None and old is not common.DATABASES[get_db_file(linked)]
+    converse(monkeypatch, client)
+
+def test_reloads_after_write_while_answering(linked, monkeypatch, capsys):
+    import filter
+    main = filter.main
+    written = []
+
+    def main_then_write(wf):
+        main(wf)
+        if written: return
+        # a sync saving its metadata while the daemon answers a query
+        con = sqlite3.connect(get_db_file(linked))
+        with con:
+            con.execute(INSERT_TXN, txn(9))
+            con.execute(BUMP_GENERATION)
+        con.close()
+        written.append(True)
+    monkeypatch.setattr(filter, 'main', main_then_write)
+
+    def client():
+        ask(capsys, 'starbucks ')
+        old = common.DATABASES[get_db_file(linked)]
+        assert 4 == len(ask(capsys, 'starbucks '))
+        db = common.DATABASES[get_db_file(linked)]
+        assert old is not db
+        # reloading once is enough, nothing has changed since
+        ask(capsys, 'starbucks ')
+        assert db is common.DATABASES[get_db_file(linked)]
+    converse(monkeypatch, client)
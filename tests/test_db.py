@@ -0,0 +1,53 @@
+import pytest
+from query import SORTS
+from conftest import txn
+
+@pytest.mark.parametrize('sort', SORTS)
+@pytest.mark.parametrize('order', ['asc', 'desc'])
+def test_sort_with_search_term(txn_db, sort, order):
+    db = txn_db([txn(i, merchant=['Starbucks', 'Chipotle'][i % 2], post=f'2024-01-{1 + i:02d}') for i in range(10)])
+    results = db.get_results(f'starbucks srt:{sort} ord:{order} ')
+    assert 5 == len(results)
+    assert {'Starbucks'} == {x['merchant'] for x in results}
+
+@pytest.mark.parametrize('sort', SORTS)
+def test_pages_cover_every_match_once(txn_db, sort):
+    # many transactions share a date and an amount, as they do in real data
+    db = txn_db([txn(i, post=f'2024-01-{1 + i % 3:02d}', amount=i % 2) for i in range(50)])
+    seen = []
+    for page in range(5):
+        seen += [x['transaction_id'] for x in db.get_results(f'starbucks srt:{sort} ', limit=12, offset=page * 12)]
+    assert sorted(seen) == sorted(f'txn{i}' for i in range(50))
+
+@pytest.mark.parametrize('order', ['asc', 'desc'])
+def test_ties_ordered_by_id(txn_db, order):
+    db = txn_db([txn(i, post='2024-01-01') for i in range(10)])
+    ids = [int(x['transaction_id'][3:]) for x in db.get_results(f'starbucks srt:post ord:{order} ')]
+    assert ids == sorted(ids, reverse='desc' == order)
+
+@pytest.mark.parametrize('search,merchant', [("mcdonald's", "McDonald's"), ('at&t', 'AT&T'), ('7-eleven', '7-Eleven'), ('7-el', '7-Eleven'), ('"quoted"', 'The "Quoted" Cafe'), ('or', 'Or Bakery')])
+def test_punctuation_in_search_terms(txn_db, search, merchant):
+    db = txn_db([txn(1, merchant=merchant), txn(2, merchant='Starbucks')])
+    assert [merchant] == [x['merchant'] for x in db.get_results(f'{search} ')]
+
+def test_invalid_match_logged_not_raised(txn_db):
+    db = txn_db([txn(1)])
+    assert [] == db.search("SELECT rowid FROM txn_fts WHERE txn_fts MATCH :query", {'query': 'AND'})
+
+@pytest.mark.parametrize('order', ['', 'ord:desc ', 'ord:asc '])
+def test_rank_order_applies_to_relevance(txn_db, order):
+    # a shorter merchant name is the closer match for the same term
+    db = txn_db([txn(1, merchant='Starbucks Reserve Roastery Seattle Washington'), txn(2, merchant='Starbucks')])
+    ids = [x['transaction_id'] for x in db.get_results(f'starbucks srt:rank {order}')]
+    assert ids == (['txn1', 'txn2'] if 'asc' in order else ['txn2', 'txn1'])
+
+def test_rank_favours_recent_matches(txn_db):
+    db = txn_db([txn(i, post=f'2024-0{1 + i}-01') for i in range(3)] + [txn(3, post='2024-03-01')])
+    # equally good matches score higher the more recent they are, same day ones newest id first
+    assert ['txn3', 'txn2', 'txn1', 'txn0'] == [x['transaction_id'] for x in db.get_results('starbucks srt:rank ')]
+
+@pytest.mark.parametrize('order', ['desc', 'asc'])
+def test_rank_without_terms_sorts_by_date(txn_db, order):
+    db = txn_db([txn(i, post=f'2024-01-{1 + i:02d}') for i in range(5)])
+    posts = [x['post'] for x in db.get_results(f'dtf:2024-01-01 srt:rank ord:{order} ')]
+    assert posts == sorted(posts, reverse='desc' == order) and 5 == len(posts)
@@ -0,0 +1,121 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import common
+from common import save_icon, get_metadata
+from prefetch import IconPrefetch
+
+PNG = b'\x89PNG\r\n\x1a\nicon'
+
+@pytest.fixture
+def icon_server():
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            if self.path.startswith('/redirect'):
+                self.send_response(302)
+                self.send_header('Location', '/logo.png')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            found = self.path.startswith('/logo')
+            content = PNG if found else b''
+            self.send_response(200 if found else 404)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+def test_save_icon_follows_redirects(wf, tmp_path, icon_server):
+    path = str(tmp_path / 'bank.png')
+    assert path == save_icon(wf, path, f'{icon_server}/redirect')
+    with open(path, 'rb') as fh:
+        assert PNG == fh.read()
+
+def test_save_icon_failure(wf, tmp_path, icon_server):
+    path = str(tmp_path / 'missing.png')
+    assert '' == save_icon(wf, path, f'{icon_server}/missing')
+    assert not os.path.exists(path) and not os.path.exists(f'{path}.part')
+
+def test_prefetch_downloads_on_pool(wf, icon_server):
+    banks = {f'ins{n}': {'name': f'Bank {n}', 'logo': f'{icon_server}/logo{n}.png', 'icon': None} for n in range(6)}
+    prefetch = IconPrefetch(wf, get_metadata(wf, 'icons'))
+    for institution_id in banks:
+        prefetch.bank(banks, institution_id)
+    prefetch.finish()
+    for bank in banks.values():
+        with open(bank['icon'], 'rb') as fh:
+            assert PNG == fh.read()
+    # the downloads went through the shared transport, not global urllib state
+    assert common.TRANSPORT is not None
+
+@pytest.fixture
+def started(monkeypatch):
+    from workflow import background
+    started = []
+    monkeypatch.setattr(background, 'run_in_background', lambda name, args: started.append(name))
+    return started
+
+def test_queued_miss_starts_fetch_again(wf, started):
+    common.take_icon_queue(wf)
+    common.queue_icons(wf, [('merchant', 'm1')])
+    # the fetch that took the first one may have finished without it
+    common.queue_icons(wf, [('merchant', 'm1')])
+    assert ['icons', 'icons'] == started
+    assert [('merchant', 'm1')] == common.take_icon_queue(wf)
+
+def test_backfill_drains_queue(wf, icon_server, started, monkeypatch):
+    import command
+    from prefetch import IconPrefetch
+    merchants = get_metadata(wf, 'merchants')
+    for n in range(2):
+        merchants[f'backfill{n}'] = {'id': f'backfill{n}', 'name': f'Backfill {n}', 'logo': f'{icon_server}/logo-backfill{n}.png'}
+    common.save_metadata(wf, 'merchants')
+    finish = IconPrefetch.finish
+
+    def queued_meanwhile(self):
+        # the filter finds another miss while the first batch downloads
+        if not started: common.queue_icons(wf, [('merchant', 'backfill1')])
+        return finish(self)
+    monkeypatch.setattr(IconPrefetch, 'finish', queued_meanwhile)
+    common.take_icon_queue(wf)
+    common.queue_icons(wf, [('merchant', 'backfill0')])
+    started.clear()
+    assert 2 == command.backfill_icons(wf)
+    assert [] == common.take_icon_queue(wf)
+    for n in range(2):
+        with open(get_metadata(wf, 'merchants')[f'backfill{n}']['icon'], 'rb') as fh:
+            assert PNG == fh.read()
+
+def test_missing_category_icons_recomputed(wf, fake_plaid, monkeypatch):
+    import command
+    from plaid import Plaid
+    monkeypatch.setattr(command, 'log', wf.logger)
+    hierarchies = {
+        13005000: ['Food and Drink', 'Restaurants'],
+        13005043: ['Food and Drink', 'Restaurants', 'Coffee Shop'],
+        22001000: ['Travel', 'Airlines and Aviation Services']
+    }
+    fake_plaid.replies['/categories/get'] = [(200, {'categories': [{'category_id': str(x), 'hierarchy': y} for x, y in hierarchies.items()]})]
+    categories = get_metadata(wf, 'categories')
+    # one that kept its icon, one whose icon file is gone and one that had none when it was worked out
+    categories[13005000] = {'id': 13005000, 'list': hierarchies[13005000], 'icon': 'icons/category/bar.png'}
+    categories[13005043] = {'id': 13005043, 'list': hierarchies[13005043], 'icon': 'icons/category/removed.png'}
+    categories[22001000] = {'id': 22001000, 'list': hierarchies[22001000], 'icon': None}
+    client = Plaid('client', 'secret', 'user', wf, base_url=fake_plaid.url)
+    categories = command.update_categories(wf, client)
+    client.close()
+    assert 'icons/category/bar.png' == categories[13005000]['icon']
+    assert 'icons/category/coffeeshop.png' == categories[13005043]['icon']
+    assert 'icons/category/airline.png' == categories[22001000]['icon']
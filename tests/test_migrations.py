@@ -0,0 +1,159 @@
+import os
+import sys
+import subprocess
+import shutil
+import sqlite3
+import pytest
+import db as txndb
+from db import TxnDB, MIGRATIONS
+
+ROWS = 500000
+# the rest of the tests use a smaller database, in batches small enough to have several
+SMALL = 20000
+BATCH = 1000
+LATEST = MIGRATIONS[-1][0]
+# txn_au as version 3 databases have it, reindexing search on any update
+OLD_TRIGGER = """CREATE TRIGGER txn_au AFTER UPDATE ON transactions BEGIN
+  INSERT INTO txn_fts(txn_fts, rowid, subtype, merchant, institution, categories) VALUES ('delete', old.id, old.subtype, old.merchant, old.institution, old.categories);
+  INSERT INTO txn_fts(rowid, subtype, merchant, institution, categories) VALUES (new.id, new.subtype, new.merchant, new.institution, new.categories);
+END"""
+
+def make_version3(file, rows):
+    """A version 3 database of `rows` transactions with dates stored as 'YYYY-MM-DD 00:00:00'"""
+    con = sqlite3.connect(file)
+    with open('create.sql') as fh:
+        con.executescript(fh.read())
+    with con:
+        con.execute("DROP TRIGGER txn_au")
+        con.execute(OLD_TRIGGER)
+        con.execute("DROP TRIGGER txn_ai")
+        con.execute(f"""WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < {rows})
+            INSERT INTO transactions (transaction_id, account_id, currency, post, auth, channel, amount, subtype, merchant, merchant_id, categories, category_id, txntext)
+            SELECT 'txn' || i, 'acct' || (i % 20), 'USD', date('2015-01-01', '+' || (i % 3650) || ' days') || ' 00:00:00',
+                CASE WHEN i % 3 THEN NULL ELSE date('2015-01-01', '+' || (i % 3650) || ' days') || ' 00:00:00' END, 'online', i % 500, 'purchase',
+                'Merchant' || (i % 2000), 'm' || (i % 2000), 'Food and Drink,Restaurants', 13005000, 'TXN ' || i FROM n""")
+        con.execute("""CREATE TRIGGER txn_ai AFTER INSERT ON transactions BEGIN
+  INSERT INTO txn_fts(rowid, subtype, merchant, institution, categories) VALUES (new.id, new.subtype, new.merchant, new.institution, new.categories);
+END""")
+        con.execute("INSERT INTO txn_fts(txn_fts) VALUES ('rebuild')")
+    con.execute("PRAGMA user_version=3")
+    con.close()
+    return file
+
+@pytest.fixture(scope='module')
+def version3(tmp_path_factory):
+    return make_version3(str(tmp_path_factory.mktemp('migrations') / 'version3.db'), SMALL)
+
+@pytest.fixture
+def old_db(version3, tmp_path, monkeypatch):
+    monkeypatch.setattr(txndb, 'MIGRATION_BATCH', BATCH)
+    file = str(tmp_path / 'txns.db')
+    shutil.copy(version3, file)
+    return file
+
+def old_dates(con):
+    return con.execute("SELECT COUNT(*) FROM transactions WHERE length(post) > 10 OR length(auth) > 10").fetchone()[0]
+
+def test_new_database_starts_at_latest(tmp_path):
+    with TxnDB(str(tmp_path / 'new.db'), defer=lambda: pytest.fail('nothing to defer')) as db:
+        assert LATEST == db.version(db.connect())
+
+def test_migrates_across_versions(tmp_path):
+    old_db = make_version3(str(tmp_path / 'txns.db'), ROWS)
+    with TxnDB(old_db) as db:
+        con = db.connect()
+        assert LATEST == db.version(con)
+        assert 0 == old_dates(con)
+        assert ROWS == con.execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
+        assert 'AFTER UPDATE OF' in con.execute("SELECT sql FROM sqlite_master WHERE name='txn_au'").fetchone()[0]
+        assert con.execute("SELECT post, auth FROM transactions WHERE id=3").fetchone()[:] == ('2015-01-04', '2015-01-04')
+        assert None is con.execute("SELECT data FROM metadata WHERE kind='db' AND id LIKE 'migration.%'").fetchone()
+        # search still matches every row
+        assert ROWS // 2000 == db.get_summary('merchant1999 ')['count']
+    # nothing left to do the next time it is opened
+    with TxnDB(old_db, defer=lambda: pytest.fail('nothing to defer')) as db:
+        assert LATEST == db.version(db.connect())
+
+def test_batched_steps_deferred(old_db):
+    deferred = []
+    with TxnDB(old_db, defer=lambda: deferred.append(True)) as db:
+        con = db.connect()
+        # schema steps ran at open, the rewrite was handed off without touching a row
+        assert [True] == deferred
+        assert LATEST - 1 == db.version(con)
+        assert SMALL == old_dates(con)
+        # old dates are searched correctly meanwhile
+        assert SMALL // 3650 == db.get_summary('dtf:2015-01-01 dtt:2015-01-01 ')['count']
+    with TxnDB(old_db) as db:
+        assert LATEST == db.version(db.connect())
+        assert SMALL // 3650 == db.get_summary('dtf:2015-01-01 dtt:2015-01-01 ')['count']
+
+class Interrupted(Exception):
+    pass
+
+def test_interrupted_rewrite_resumes(old_db, monkeypatch):
+    calls = []
+    rewrite = TxnDB.migrate_iso_dates
+
+    def interrupted(self, con, first, last):
+        calls.append(first)
+        if 3 == len(calls): raise Interrupted()
+        return rewrite(self, con, first, last)
+    monkeypatch.setattr(TxnDB, 'migrate_iso_dates', interrupted)
+    with pytest.raises(Interrupted):
+        TxnDB(old_db).connect()
+    monkeypatch.setattr(TxnDB, 'migrate_iso_dates', rewrite)
+    with TxnDB(old_db, defer=lambda: None) as db:
+        con = db.connect()
+        assert LATEST - 1 == db.version(con)
+        # the two committed batches stay rewritten, the interrupted one was rolled back
+        assert SMALL - 2 * BATCH == old_dates(con)
+        assert str(2 * BATCH) == con.execute("SELECT data FROM metadata WHERE kind='db' AND id='migration.5'").fetchone()[0]
+    resumed = []
+
+    def recorded(self, con, first, last):
+        resumed.append(first)
+        return rewrite(self, con, first, last)
+    monkeypatch.setattr(TxnDB, 'migrate_iso_dates', recorded)
+    with TxnDB(old_db) as db:
+        assert LATEST == db.version(db.connect())
+        assert 0 == old_dates(db.connect())
+    # carried on from the first batch that was not committed
+    assert 2 * BATCH == resumed[0]
+
+def test_writers_get_in_between_batches(old_db, monkeypatch):
+    rewrite = TxnDB.migrate_iso_dates
+    other = sqlite3.connect(old_db, timeout=0)
+    written = []
+
+    def batch(self, con, first, last):
+        # another process writing between batches is not kept waiting
+        with other:
+            other.execute("INSERT INTO metadata (kind, id, data) VALUES ('test', ?, '')", (str(first),))
+        written.append(first)
+        return rewrite(self, con, first, last)
+    monkeypatch.setattr(TxnDB, 'migrate_iso_dates', batch)
+    with TxnDB(old_db) as db:
+        db.connect()
+    other.close()
+    assert SMALL // BATCH == len(written)
+
+def test_rewrite_runs_in_background_job(wf, old_db, monkeypatch):
+    import common
+    from workflow import background
+    started = []
+    monkeypatch.setattr(background, 'run_in_background', lambda name, args: started.append((name, args[1:])))
+    file = common.get_db_file(wf)
+    if file in common.DATABASES: common.DATABASES.pop(file).close()
+    for name in [f'{file}-wal', f'{file}-shm']:
+        if os.path.exists(name): os.remove(name)
+    shutil.copy(old_db, file)
+    db = common.get_db(wf)
+    assert LATEST - 1 == db.version(db.connect())
+    assert [('migrate', ['command.py', '--migrate'])] == started
+    common.DATABASES.pop(file).close()
+    # the job the filter starts
+    subprocess.run([sys.executable, 'command.py', '--migrate'], env=os.environ.copy(), check=True, capture_output=True)
+    with TxnDB(file) as db:
+        assert LATEST == db.version(db.connect())
+        assert 0 == old_dates(db.connect())
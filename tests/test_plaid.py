@@ -0,0 +1,63 @@
+import socket
+import pytest
+import plaid
+from plaid import Plaid, PlaidError, BREAKER_THRESHOLD
+
+@pytest.fixture
+def client(wf, fake_plaid, monkeypatch):
+    monkeypatch.setattr(plaid, 'RETRY_BASE_DELAY', 0.001)
+    client = Plaid('client', 'secret', 'user', wf, base_url=fake_plaid.url)
+    yield client
+    client.close()
+
+def test_gzip_and_keep_alive(client, fake_plaid):
+    fake_plaid.replies['/item/get'] = [(200, {'item': {'institution_id': 'ins_1'}})]
+    for _ in range(5):
+        assert client.api('/item/get', {'access_token': 'tok'})['item']['institution_id'] == 'ins_1'
+    assert 5 == len(fake_plaid.calls)
+    # every call went over the one kept-alive connection
+    assert 1 == len(fake_plaid.clients)
+
+def test_credentials_sent(client, fake_plaid):
+    client.api('/item/get', {'access_token': 'tok'})
+    assert {'client_id': 'client', 'secret': 'secret', 'access_token': 'tok'} == fake_plaid.calls[0][1]
+    client.api('/categories/get', {}, no_auth=True)
+    assert {} == fake_plaid.calls[1][1]
+
+def test_rate_limit_retried(client, fake_plaid):
+    fake_plaid.replies['/transactions/sync'] = [
+        (429, {'error_type': 'RATE_LIMIT_EXCEEDED', 'error_code': 'TRANSACTIONS_SYNC_LIMIT'}),
+        (200, {'added': [], 'has_more': False})
+    ]
+    assert {'added': [], 'has_more': False} == client.api('/transactions/sync', {'access_token': 'tok'})
+    assert 2 == len(fake_plaid.calls)
+
+def test_client_error_not_retried(client, fake_plaid):
+    fake_plaid.replies['/item/get'] = [(400, {'error_type': 'ITEM_ERROR', 'error_code': 'ITEM_LOGIN_REQUIRED'})]
+    assert 'ITEM_LOGIN_REQUIRED' == client.api('/item/get', {'access_token': 'tok'})['error_code']
+    assert 1 == len(fake_plaid.calls)
+
+def test_read_timeout_retried_on_read_endpoint(client, fake_plaid):
+    fake_plaid.replies['/accounts/get'] = [(200, {}, 0.5), (200, {'accounts': []})]
+    assert {'accounts': []} == client.api('/accounts/get', {'access_token': 'tok'}, timeout=0.2)
+    assert 2 == len(fake_plaid.calls)
+
+def test_read_timeout_not_retried_on_write_endpoint(client, fake_plaid):
+    # the public token only works once, sending it again would lose the access token
+    fake_plaid.replies['/item/public_token/exchange'] = [(200, {'access_token': 'tok'}, 0.5)]
+    with pytest.raises(socket.timeout):
+        client.api('/item/public_token/exchange', {'public_token': 'public'}, timeout=0.2)
+    assert ['/item/public_token/exchange'] == fake_plaid.paths()
+
+def test_circuit_breaker(client, fake_plaid):
+    fake_plaid.replies['/transactions/sync'] = [(500, {'error_type': 'API_ERROR', 'error_code': 'INTERNAL_SERVER_ERROR'})]
+    for _ in range(BREAKER_THRESHOLD):
+        client.api('/transactions/sync', {'access_token': 'bad'})
+    calls = len(fake_plaid.calls)
+    with pytest.raises(PlaidError) as e:
+        client.api('/transactions/sync', {'access_token': 'bad'})
+    assert 'CIRCUIT_OPEN' == e.value.code
+    assert calls == len(fake_plaid.calls)
+    # other items are not affected
+    fake_plaid.replies['/transactions/sync'] = [(200, {'added': []})]
+    assert {'added': []} == client.api('/transactions/sync', {'access_token': 'good'})
@@ -0,0 +1,19 @@
+from query import parse_query, fts_term
+
+def test_terms_and_filters():
+    q = parse_query('coffee act:a1,a2 amtf:10 srt:Amount ord:asc dt:last-month ')
+    assert ('coffee',) == q.terms
+    assert {'act': ('a1', 'a2'), 'amtf': 10, 'srt': 'amount', 'ord': 'ASC', 'dt': 'last-month'} == q.filters
+
+def test_filter_being_typed_not_applied():
+    q = parse_query('coffee amtf:1')
+    assert 'amtf' not in q.filters
+    assert [('amtf', '1', False)] == q.tokens
+    assert ('1', 'coffee ') == q.tail('amtf')
+
+def test_invalid_values_dropped():
+    assert {} == parse_query('srt:drop ord:sideways amtf:x dtf:notadate ').filters
+
+def test_match_quotes_terms():
+    assert '"at&t"* "mcdonald\'s"*' == parse_query("at&t mcdonald's ").match
+    assert '"say ""hi"""*' == fts_term('say "hi"')
@@ -0,0 +1,74 @@
+import pytest
+from db import TxnDB
+from query import SORTS
+
+ROWS = 1000000
+INDEXES = ['txn_post_idx', 'txn_amount_idx', 'txn_account_post_idx', 'txn_category_post_idx']
+# index each filter should be answered from, with the default sort
+EXPECTED = {
+    'act:acct1 dtf:2020-01-01 ': 'txn_account_post_idx',
+    'cat:13005000 ': 'txn_category_post_idx',
+    'txn:txn5 ': 'sqlite_autoindex_transactions_1',
+    'dtf:2020-01-01 dtt:2020-02-01 ': 'txn_post_idx',
+    'dt:last-month ': 'txn_post_idx',
+    'amtf:100 amtt:101 ': 'txn_amount_idx',
+    'merchant7 ': 'INTEGER PRIMARY KEY'
+}
+COMBINATIONS = [
+    *EXPECTED,
+    'act:acct1,acct2 dtf:2020-01-01 dtt:2020-02-01 ',
+    'act:acct1 cat:13005000 ',
+    'cat:13005000 dtf:2020-01-01 ',
+    'cat:13005000 amtf:100 ',
+    'txn:txn5 act:acct5 ',
+    'merchant7 act:acct3 ',
+    'merchant7 cat:13005000 ',
+    'merchant7 dtf:2020-01-01 dtt:2020-02-01 ',
+    'merchant7 amtf:100 '
+]
+
+@pytest.fixture(scope='module')
+def big_db(tmp_path_factory):
+    """1M synthetic transactions over 10 years, 20 accounts, 600 categories and 2000 merchants
+
+    Rows are loaded without the indexes and FTS trigger, which are then built
+    in one go from create.sql - inserting through them takes several times longer.
+    """
+    db = TxnDB(str(tmp_path_factory.mktemp('plan') / 'txns.db'))
+    con = db.connect()
+    con.execute("PRAGMA synchronous=OFF")
+    with con:
+        con.execute("DROP TRIGGER txn_ai")
+        for index in INDEXES:
+            con.execute(f"DROP INDEX {index}")
+        con.execute(f"""WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < {ROWS})
+            INSERT INTO transactions (transaction_id, account_id, currency, post, channel, amount, subtype, merchant, merchant_id, categories, category_id, txntext)
+            SELECT 'txn' || i, 'acct' || (i % 20), 'USD', date('2015-01-01', '+' || (i % 3650) || ' days'), 'online', (i % 5000) / 10.0, 'purchase',
+                'Merchant' || (i % 2000), 'm' || (i % 2000), 'Food and Drink,Restaurants', 10000000 + (i % 600) * 1000, 'TXN ' || i FROM n""")
+        con.execute("INSERT INTO txn_fts(txn_fts) VALUES ('rebuild')")
+    db.migrate_objects(con)
+    con.execute("ANALYZE")
+    yield db
+    db.close()
+
+def full_scans(plan):
+    """Steps that read a whole table rather than searching an index"""
+    return [x for x in plan if x.startswith('SCAN') and 'VIRTUAL TABLE' not in x and ' USING ' not in x]
+
+@pytest.mark.parametrize('query', COMBINATIONS)
+@pytest.mark.parametrize('sort', SORTS)
+def test_filters_use_an_index(big_db, query, sort):
+    plan = big_db.explain(f'{query}srt:{sort} ')
+    assert plan
+    assert not full_scans(plan), plan
+    assert any(' USING ' in x for x in plan), plan
+
+@pytest.mark.parametrize('query,index', EXPECTED.items())
+def test_filter_index(big_db, query, index):
+    plan = big_db.explain(query)
+    assert any(index in x for x in plan), plan
+
+def test_terms_joined_from_fts(big_db):
+    plan = big_db.explain('merchant7 act:acct3 ')
+    assert any(x.startswith('SCAN txn_fts VIRTUAL TABLE') for x in plan), plan
+    assert 'SEARCH t USING INTEGER PRIMARY KEY (rowid=?)' in plan
@@ -0,0 +1,83 @@
+import sys
+import json
+import pytest
+import filter
+import command
+from workflow import Workflow
+from common import DATABASES, get_db, get_db_file, get_metadata, save_metadata
+from conftest import plaid_txn
+
+@pytest.fixture
+def search(linked, monkeypatch, capsys):
+    """Runs a search as a new filter process would, returns its titles and how many times results were built"""
+    build_results = filter.build_results
+    built = []
+
+    def counted(*args):
+        built.append(True)
+        return build_results(*args)
+    monkeypatch.setattr(filter, 'build_results', counted)
+    linked.cache_data(filter.RESULTS_CACHE, None)
+
+    def run(query):
+        wf = Workflow()
+        filter.wf = wf
+        filter.log = wf.logger
+        monkeypatch.setattr(sys, 'argv', ['filter.py', query])
+        capsys.readouterr()
+        filter.main(wf)
+        DATABASES.pop(get_db_file(linked)).close()
+        items = json.loads(capsys.readouterr().out)['items']
+        return [(x['title'], x.get('subtitle')) for x in items if 'Starbucks' in x['title']], len(built)
+    # the first search indexes the icon directories, which is a change of its own
+    run('starbucks ')
+    linked.cache_data(filter.RESULTS_CACHE, None)
+    built.clear()
+    return run
+
+def run_command(monkeypatch, *args):
+    wf = Workflow()
+    monkeypatch.setattr(command, 'log', wf.logger)
+    monkeypatch.setattr(sys, 'argv', ['command.py', *args])
+    command.main(wf)
+    db = DATABASES.pop(get_db_file(wf), None)
+    if db: db.close()
+
+def test_repeat_served_from_cache(search):
+    results, built = search('starbucks ')
+    assert 3 == len(results) and 1 == built
+    assert (results, 1) == search('starbucks ')
+    # a different query is built on its own, and does not push out the first
+    assert 2 == search('starbucks srt:amount ')[1]
+    assert (results, 2) == search('starbucks ')
+
+def test_recategorization_invalidates(linked, search, monkeypatch):
+    categories = get_metadata(linked, 'categories')
+    categories[22001000] = {'id': 22001000, 'list': ['Travel', 'Airlines and Aviation Services'], 'icon': None}
+    merchants = get_metadata(linked, 'merchants')
+    merchants['m_Starbucks'] = {'id': 'm_Starbucks', 'name': 'Starbucks', 'category_id': 13005000, 'logo': None, 'url': None, 'categories': None}
+    save_metadata(linked, 'categories')
+    save_metadata(linked, 'merchants')
+    DATABASES.pop(get_db_file(linked)).close()
+    before, _ = search('starbucks ')
+    run_command(monkeypatch, '--category_id', '22001000', '--merchant_id', 'm_Starbucks')
+    after, built = search('starbucks ')
+    assert 2 == built and before != after
+    assert all('Airlines' in x[1] for x in after)
+    # recategorizing by name is kept outside the database
+    run_command(monkeypatch, '--category_id', '13005000', '--merchant', 'Starbucks')
+    assert 3 == search('starbucks ')[1]
+
+def test_sync_invalidates(linked, search):
+    search('starbucks ')
+    get_db(linked).apply_sync({'added': [plaid_txn('s1')], 'next_cursor': 'c1'}, linked, 'item1')
+    DATABASES.pop(get_db_file(linked)).close()
+    results, built = search('starbucks ')
+    assert 4 == len(results) and 2 == built
+
+def test_nickname_invalidates(linked, search, monkeypatch):
+    search('starbucks ')
+    run_command(monkeypatch, '--acctid', 'acct1', '--nick', 'Everyday')
+    results, built = search('starbucks ')
+    assert 2 == built
+    assert all('Everyday' in x[1] for x in results)
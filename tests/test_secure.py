@@ -0,0 +1,117 @@
+import os
+import stat
+import pytest
+import plaid
+import command
+from secure import SecureStore, FileBackend
+from common import get_items, set_items, secure_session, get_secure_store, commit_secure_values
+
+class CountingBackend(FileBackend):
+    def __init__(self, path):
+        super().__init__(path)
+        self.saves = 0
+
+    def save(self, data):
+        self.saves += 1
+        super().save(data)
+
+class Failed(Exception):
+    pass
+
+@pytest.fixture
+def store(tmp_path):
+    return SecureStore(CountingBackend(str(tmp_path / 'secure.json')))
+
+def test_writes_immediately_outside_session(store):
+    store.get()['a'] = 1
+    store.changed()
+    assert 1 == store.backend.saves
+    assert {'a': 1} == FileBackend(store.backend.path).load()
+    assert stat.S_IMODE(os.stat(store.backend.path).st_mode) == 0o600
+
+def test_session_writes_once(store):
+    with store.session():
+        for n in range(5):
+            store.get()[f'k{n}'] = n
+            store.changed()
+        # nested sessions join the outer one
+        with store.session():
+            store.get()['nested'] = True
+            store.changed()
+        assert 0 == store.backend.saves
+    assert 1 == store.backend.saves
+    assert {'k0': 0, 'k1': 1, 'k2': 2, 'k3': 3, 'k4': 4, 'nested': True} == FileBackend(store.backend.path).load()
+
+def test_session_without_changes_does_not_write(store):
+    with store.session():
+        store.get()
+    assert 0 == store.backend.saves
+
+def test_session_rolls_back(store):
+    store.get()['kept'] = 1
+    store.changed()
+    with pytest.raises(Failed):
+        with store.session():
+            store.get()['lost'] = 2
+            store.changed()
+            raise Failed()
+    assert {'kept': 1} == store.get()
+    assert {'kept': 1} == FileBackend(store.backend.path).load()
+    assert 1 == store.backend.saves
+
+def test_commit_survives_rollback(store):
+    with pytest.raises(Failed):
+        with store.session():
+            store.get()['committed'] = 1
+            store.changed()
+            store.commit()
+            store.get()['lost'] = 2
+            store.changed()
+            raise Failed()
+    assert {'committed': 1} == store.get()
+    assert {'committed': 1} == FileBackend(store.backend.path).load()
+
+def test_committed_token_kept(linked):
+    with pytest.raises(Failed):
+        with secure_session(linked):
+            set_items(linked, {**get_items(linked), 'item2': {'item_id': 'item2', 'institution_id': 'ins1', 'error': None, 'access_token': 'tok2'}})
+            commit_secure_values(linked)
+            raise Failed()
+    assert 'tok2' == get_items(linked)['item2']['access_token']
+    # and it is on disk, not just in this process
+    assert 'tok2' == SecureStore(FileBackend(get_secure_store(linked).backend.path)).get()['sandbox']['user']['tokens']['item2']
+
+def test_link_keeps_token_when_update_fails(linked, fake_plaid, monkeypatch):
+    monkeypatch.setattr(plaid, 'RETRY_BASE_DELAY', 0.001)
+    client = plaid.Plaid('client', 'secret', 'user', linked, base_url=fake_plaid.url)
+    fake_plaid.replies['/item/public_token/exchange'] = [(200, {'access_token': 'tok2', 'item_id': 'item2'})]
+    # the item is found once, then Plaid fails while the new item is being updated
+    fake_plaid.replies['/item/get'] = [
+        (200, {'item': {'item_id': 'item2', 'institution_id': 'ins1', 'error': None, 'consent_expiration_time': None}}),
+        (500, {'error_type': 'API_ERROR', 'error_code': 'INTERNAL_SERVER_ERROR'})
+    ]
+    with pytest.raises(TypeError):
+        with secure_session(linked):
+            command.link_item(linked, client, 'public')
+    client.close()
+    # the public token is used up, losing the access token would lose the item
+    assert ['/item/public_token/exchange'] == [x for x in fake_plaid.paths() if 'exchange' in x]
+    assert 'tok2' == get_items(linked)['item2']['access_token']
+
+def test_items_without_token_skipped(linked, fake_plaid, monkeypatch, capsys):
+    monkeypatch.setattr(command, 'log', linked.logger)
+    with pytest.raises(Failed):
+        with secure_session(linked):
+            set_items(linked, {**get_items(linked), 'item2': {'item_id': 'item2', 'institution_id': 'ins1', 'error': None, 'access_token': 'tok2'}})
+            raise Failed()
+    # the item itself was saved locally, its token was thrown away
+    assert 'item2' in get_items(linked, False)
+    assert ['item1'] == list(get_items(linked))
+    client = plaid.Plaid('client', 'secret', 'user', linked, base_url=fake_plaid.url)
+    fake_plaid.replies['/item/get'] = [(200, {'item': {'item_id': 'item1', 'institution_id': 'ins1', 'error': None, 'consent_expiration_time': None}})]
+    command.update_items(linked, client)
+    client.close()
+    # the sync never sent a missing token, and asked for the item to be linked again
+    assert [{'client_id': 'client', 'secret': 'secret', 'access_token': 'tok1'}] == [x[1] for x in fake_plaid.calls]
+    assert 'Bank needs to be linked again' in capsys.readouterr().out
+    assert ['item1'] == list(get_items(linked, False))
@@ -0,0 +1,54 @@
+import os
+import sys
+import subprocess
+import pytest
+from conftest import ROOT
+
+# cold start budget in milliseconds for importing each entry point, the best of RUNS runs.
+# generous for slow machines - the module lists below are what catch most regressions
+BUDGET = {'filter': 400, 'command': 400, 'daemon': 150}
+RUNS = 3
+# only loaded by the code paths that use them - a plain search or --nick must not pay for them
+DEFERRED = {
+    'filter': ['dateutil', 'dateutil.parser', 'dateutil.relativedelta', 'urllib.parse', 'ssl', 'http.server', 'server', 'plaid', 'transport', 'prefetch', 'concurrent.futures', 'workflow.web'],
+    'command': ['dateutil', 'ssl', 'http.server', 'server', 'plaid', 'transport', 'prefetch', 'concurrent.futures', 'urllib.parse', 'workflow.web'],
+    # the client side of the daemon runs on every keystroke
+    'daemon': ['workflow', 'filter', 'common', 'db', 'sqlite3', 'dateutil']
+}
+
+def import_times(module):
+    """module -> cumulative import time in microseconds, from -X importtime"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=ROOT, env=os.environ.copy(), capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line: continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+@pytest.mark.parametrize('module', DEFERRED)
+def test_deferred_imports(module):
+    loaded = import_times(module)
+    assert [] == [x for x in DEFERRED[module] if x in loaded]
+
+@pytest.mark.parametrize('module', BUDGET)
+def test_cold_start_budget(module):
+    best = min(import_times(module)[module] for _ in range(RUNS)) / 1000
+    assert best < BUDGET[module], f'importing {module} took {best:.0f}ms, budget is {BUDGET[module]}ms'
+
+def test_search_path(linked):
+    """Answering a plain search in-process, as filter.py does when no daemon is running"""
+    code = """import sys
+import filter
+from workflow import Workflow
+wf = Workflow()
+filter.wf = wf
+filter.log = wf.logger
+sys.argv = ['filter.py', 'starbucks ']
+filter.main(wf)
+print()
+print([x for x in sys.modules if x.split('.')[0] in ('dateutil', 'ssl', 'plaid', 'transport', 'prefetch', 'concurrent')])
+"""
+    result = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=os.environ.copy(), capture_output=True, text=True, check=True)
+    assert 'Starbucks' in result.stdout
+    assert '[]' == result.stdout.splitlines()[-1]
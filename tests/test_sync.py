@@ -0,0 +1,140 @@
+import time
+import sqlite3
+import threading
+import pytest
+import plaid
+import command
+from common import DATABASES, get_db_file, get_metadata, get_items, set_items, get_local_value
+from plaid import Plaid
+from db import TxnDB
+from conftest import plaid_txn
+
+CATEGORIES = {'categories': [{'category_id': '13005000', 'hierarchy': ['Food and Drink', 'Restaurants']}]}
+
+def page(cursor, added=(), modified=(), removed=(), more=False):
+    return (200, {'added': list(added), 'modified': list(modified), 'removed': [{'transaction_id': x} for x in removed], 'next_cursor': cursor, 'has_more': more})
+
+class Killed(BaseException):
+    """The sync process going away mid-sync"""
+
+@pytest.fixture
+def sync(linked, fake_plaid, monkeypatch):
+    """Runs a sync against FakePlaid, `pages[access token][cursor]` is the reply to each /transactions/sync call"""
+    monkeypatch.setattr(command, 'log', linked.logger)
+    monkeypatch.setattr(plaid, 'RETRY_BASE_DELAY', 0.001)
+    pages = {}
+    fake_plaid.replies['/item/get'] = [(200, {'item': {'institution_id': 'ins1', 'error': None, 'consent_expiration_time': None}})]
+    fake_plaid.replies['/categories/get'] = [(200, CATEGORIES)]
+    fake_plaid.replies['/accounts/get'] = lambda body: (200, {
+        'accounts': [{'account_id': f"acct{body['access_token'][3:]}", 'name': 'Checking', 'subtype': 'checking'}],
+        'item': {'item_id': f"item{body['access_token'][3:]}", 'institution_id': 'ins1'}
+    })
+    fake_plaid.replies['/transactions/sync'] = lambda body: pages[body['access_token']][body.get('cursor')]
+    client = Plaid('client', 'secret', 'user', linked, base_url=fake_plaid.url)
+
+    def run(replies):
+        pages.clear()
+        pages.update(replies)
+        try:
+            return command.update_transactions(linked, client)
+        finally:
+            # every sync runs in a process of its own
+            DATABASES.pop(get_db_file(linked)).close()
+    yield run
+    client.close()
+
+def stored(wf, sql, *params):
+    con = sqlite3.connect(get_db_file(wf))
+    try:
+        return con.execute(sql, params).fetchall()
+    finally:
+        con.close()
+
+def test_merchants_saved_with_their_page(linked, sync, monkeypatch):
+    apply_sync = TxnDB.apply_sync
+    applied = []
+
+    def killed(self, *args):
+        applied.append(True)
+        if 2 == len(applied): raise Killed()
+        return apply_sync(self, *args)
+    monkeypatch.setattr(TxnDB, 'apply_sync', killed)
+    with pytest.raises(Killed):
+        sync({'tok1': {None: page('c1', [plaid_txn('s1', 'Peets')], more=True), 'c1': page('c2', [plaid_txn('s2', 'Blue Bottle')])}})
+    monkeypatch.setattr(TxnDB, 'apply_sync', apply_sync)
+    assert [('c1',)] == stored(linked, "SELECT cursor FROM sync_cursors WHERE item_id='item1'")
+    # the first page is never fetched again, its merchants were saved with it
+    assert 'Peets' == get_metadata(linked, 'merchants')['m_Peets']['name']
+    DATABASES.pop(get_db_file(linked)).close()
+    sync({'tok1': {'c1': page('c2', [plaid_txn('s2', 'Blue Bottle')])}})
+    merchants = get_metadata(linked, 'merchants')
+    assert ['Peets', 'Blue Bottle'] == [merchants[x]['name'] for x in ['m_Peets', 'm_Blue Bottle']]
+
+def add_item2(wf):
+    set_items(wf, {**get_items(wf), 'item2': {'item_id': 'item2', 'institution_id': 'ins1', 'error': None, 'access_token': 'tok2'}})
+
+def sync_cursors(wf):
+    return dict(stored(wf, "SELECT item_id, cursor FROM sync_cursors"))
+
+def transactions(wf):
+    return dict(stored(wf, "SELECT transaction_id, amount FROM transactions WHERE transaction_id LIKE 's%'"))
+
+def test_items_synced_in_parallel(linked, sync, fake_plaid):
+    add_item2(linked)
+    pages = fake_plaid.replies['/transactions/sync']
+    lock = threading.Lock()
+    active = [0, 0]  # in flight, most at once
+
+    def measured(body):
+        with lock:
+            active[0] += 1
+            active[1] = max(active)
+        time.sleep(0.2)
+        with lock:
+            active[0] -= 1
+        return pages(body)
+    fake_plaid.replies['/transactions/sync'] = measured
+    assert 4 == sync({
+        'tok1': {None: page('a1', [plaid_txn('s1')], more=True), 'a1': page('a2', [plaid_txn('s2')])},
+        'tok2': {None: page('b1', [plaid_txn('s3', account='acct2')], more=True), 'b1': page('b2', [plaid_txn('s4', account='acct2')])}
+    })
+    assert 2 == active[1]
+    assert ['s1', 's2', 's3', 's4'] == sorted(transactions(linked))
+    assert {'item1': 'a2', 'item2': 'b2'} == sync_cursors(linked)
+    assert {'acct1', 'acct2'} <= set(get_local_value(linked, 'accounts'))
+
+def test_failed_page_stops_item(linked, sync, capsys):
+    add_item2(linked)
+    broken = {**plaid_txn('s2')}
+    del broken['amount']
+    sync({
+        'tok1': {None: page('a1', [plaid_txn('s1')], more=True), 'a1': page('a2', [broken], more=True), 'a2': page('a3', [plaid_txn('s3')])},
+        'tok2': {None: page('b1', [plaid_txn('s4', account='acct2')])}
+    })
+    # the pages after the one that failed were not applied, the cursor stays before it
+    assert ['s1', 's4'] == sorted(transactions(linked))
+    assert {'item1': 'a1', 'item2': 'b1'} == sync_cursors(linked)
+    assert 'Bank update failed' in capsys.readouterr().out
+
+def test_plaid_error_keeps_cursor(linked, sync):
+    sync({'tok1': {None: page('a1', [plaid_txn('s1')], more=True), 'a1': (400, {'error_type': 'TRANSACTIONS_ERROR', 'error_code': 'TRANSACTIONS_SYNC_MUTATION_DURING_PAGINATION'})}})
+    assert ['s1'] == sorted(transactions(linked))
+    assert {'item1': 'a1'} == sync_cursors(linked)
+
+def test_modified_and_removed(linked, sync):
+    sync({'tok1': {None: page('a1', [plaid_txn(x) for x in ['s1', 's2', 's3']])}})
+    sync({'tok1': {'a1': page('a2', [plaid_txn('s4')], modified=[plaid_txn('s1', amount=9.0)], removed=['s2'])}})
+    assert {'s1': 9.0, 's3': 1.0, 's4': 1.0} == transactions(linked)
+
+def test_resumes_from_saved_cursor(linked, sync, fake_plaid):
+    # cursors kept on the item by older versions are carried over to the database
+    items = get_items(linked)
+    items['item1']['txn_cursor'] = 'legacy'
+    set_items(linked, items)
+    sync({'tok1': {'legacy': page('a1', [plaid_txn('s1')])}})
+    assert {'item1': 'a1'} == sync_cursors(linked)
+    assert 'txn_cursor' not in get_items(linked)['item1']
+    fake_plaid.calls.clear()
+    sync({'tok1': {'a1': page('a2', [plaid_txn('s2')])}})
+    assert ['a1'] == [x[1].get('cursor') for x in fake_plaid.calls if '/transactions/sync' == x[0]]
+    assert ['s1', 's2'] == sorted(transactions(linked))
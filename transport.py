@@ -0,0 +1,175 @@
+import http.client
+import json
+import gzip
+import threading
+from time import monotonic, sleep
+from urllib.parse import urlsplit, urljoin
+
+DEFAULT_TIMEOUT = 30
+MAX_REDIRECTS = 5
+
+# errors that mean a kept-alive connection was closed by the server while idle
+STALE_ERRORS = (http.client.RemoteDisconnected, http.client.CannotSendRequest, ConnectionResetError, BrokenPipeError)
+
+class Response:
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def header(self, name):
+        return next((v for k, v in self.headers.items() if k.lower() == name.lower()), None)
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8')) if self.content else None
+
+class Transport:
+    """HTTP(S) client that keeps one persistent connection per host
+
+    Connections are kept per thread so concurrent syncs never share a socket.
+    `http` URLs are supported too so it can be pointed at a local stand-in server.
+    """
+    def __init__(self, timeout=DEFAULT_TIMEOUT, context=None, logger=None):
+        self.timeout = timeout
+        self.context = context
+        self.logger = logger
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.opened = []
+
+    def debug(self, text):
+        if(self.logger): self.logger.debug(text)
+
+    def connections(self):
+        if not hasattr(self.local, 'connections'):
+            self.local.connections = {}
+        return self.local.connections
+
+    def connection(self, scheme, host, timeout):
+        connections = self.connections()
+        key = (scheme, host)
+        reused = key in connections
+        if not reused:
+            if 'https' == scheme:
+                connections[key] = http.client.HTTPSConnection(host, timeout=timeout, context=self.context)
+            else:
+                connections[key] = http.client.HTTPConnection(host, timeout=timeout)
+            with self.lock:
+                self.opened.append(connections[key])
+            self.debug(f"transport: opened connection to {scheme}://{host}")
+        con = connections[key]
+        con.timeout = timeout
+        if con.sock: con.sock.settimeout(timeout)
+        return con, reused
+
+    def drop(self, scheme, host):
+        con = self.connections().pop((scheme, host), None)
+        if con:
+            con.close()
+            with self.lock:
+                if con in self.opened: self.opened.remove(con)
+
+    def request(self, method, url, data=None, headers={}, timeout=None):
+        parts = urlsplit(url)
+        path = f"{parts.path or '/'}{'?' + parts.query if parts.query else ''}"
+        headers = {'Accept-Encoding': 'gzip', 'Connection': 'keep-alive', **headers}
+        body = data.encode('utf-8') if isinstance(data, str) else data
+        timeout = timeout if timeout else self.timeout
+        while True:
+            con, reused = self.connection(parts.scheme, parts.netloc, timeout)
+            try:
+                con.request(method, path, body=body, headers=headers)
+                r = con.getresponse()
+                content = r.read()
+                break
+            except STALE_ERRORS:
+                self.drop(parts.scheme, parts.netloc)
+                # only a reused connection can have gone stale, a fresh one failing is a real error
+                if not reused: raise
+            except Exception:
+                self.drop(parts.scheme, parts.netloc)
+                raise
+        if 'gzip' == r.getheader('Content-Encoding'):
+            content = gzip.decompress(content)
+        if r.will_close:
+            self.drop(parts.scheme, parts.netloc)
+        return Response(r.status, dict(r.getheaders()), content)
+
+    def post(self, url, data=None, headers={}, timeout=None):
+        return self.request('POST', url, data=data, headers=headers, timeout=timeout)
+
+    def get(self, url, headers={}, timeout=None, redirects=MAX_REDIRECTS):
+        """GET `url`, following up to `redirects` redirects"""
+        for _ in range(redirects + 1):
+            r = self.request('GET', url, headers=headers, timeout=timeout)
+            if r.status_code not in (301, 302, 303, 307, 308) or not r.header('Location'): break
+            url = urljoin(url, r.header('Location'))
+        return r
+
+    def close(self):
+        """Close the connections opened by every thread"""
+        with self.lock:
+            for con in self.opened:
+                con.close()
+            self.opened = []
+        self.local = threading.local()
+
+class TokenBucket:
+    """Blocks callers so that no more than `rate` calls a second are made, in bursts of up to `capacity`"""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+    def drain(self):
+        """Empty the bucket - used when the server says we are going too fast"""
+        with self.lock:
+            self.tokens = 0
+            self.updated = monotonic()
+
+class CircuitBreaker:
+    """Stops calling something that keeps failing until `cooldown` seconds have passed
+
+    After `threshold` consecutive failures the circuit opens and `allow` returns
+    False. Once the cooldown is over a single trial call is let through, and
+    its outcome closes or re-opens the circuit.
+    """
+    def __init__(self, threshold=3, cooldown=60):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened is None: return True
+            if monotonic() - self.opened >= self.cooldown:
+                self.opened = monotonic()  # half open - one trial per cooldown
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened = monotonic()